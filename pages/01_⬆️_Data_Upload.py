@@ -40,21 +40,35 @@ def app():
     st.markdown("## Upload barcode **count data**  file and **sample data** file\n"
                 f"Learn more about file format [here]({count_url}). "
                 "Required for **Exploratory Analysis** page.")
+    count_format = st.radio('Count data format', ['Merged count table', 'Per-sample count files'], horizontal=True,
+                            help='Per-sample files produced by `mbarq count` are merged here, '
+                                 'so you do not need to run `mbarq merge` first')
     with st.form("count-form", clear_on_submit=True):
-        count_file = st.file_uploader('Upload a file containing merged count data', key='count_file_key')
+        if count_format == 'Merged count table':
+            count_file = st.file_uploader('Upload a file containing merged count data', key='count_file_key')
+            sample_count_files, gene_attribute = [], None
+        else:
+            count_file = None
+            sample_count_files = st.file_uploader('Upload per-sample count files (ex. `sample1_mbarq_counts.csv`)',
+                                                  accept_multiple_files=True, key='sample_count_files_key')
+            gene_attribute = st.text_input('Annotation column to use as gene identifier', value='Name')
         sample_file = st.file_uploader('Upload a file containing sample data', key='sample_data_key')
         st.form_submit_button("Submit")
 
-    if count_file is not None and sample_file is not None:
-        cds = CountDataSet(count_file, sample_file)
+    if (count_file is not None or sample_count_files) and sample_file is not None:
+        cds = CountDataSet(count_file, sample_file, sample_count_files=sample_count_files,
+                           gene_attribute=gene_attribute)
         # todo add validation step?
         st.session_state['count_ds'] = cds
 
     if st.button('Clear loaded count and sample data', key='count_clear_button') and 'count_ds' in st.session_state.keys():
         del st.session_state['count_ds']
     if 'count_ds' in st.session_state.keys():
-        st.info(f'**Currently loaded  files**: `{st.session_state["count_ds"].count_file.name}` '
-                f'and `{st.session_state["count_ds"].sample_data_file.name}`')
+        loaded_cds = st.session_state["count_ds"]
+        count_names = (f'{len(loaded_cds.sample_count_files)} per-sample count files' if loaded_cds.sample_count_files
+                       else f'`{loaded_cds.count_file.name}`')
+        st.info(f'**Currently loaded  files**: {count_names} '
+                f'and `{loaded_cds.sample_data_file.name}`')
     else:
         st.info("**No count/sample files are currently loaded**")
 
@@ -79,6 +93,7 @@ def app():
             if rds.gene_id in st.session_state['annotations'].columns:
                 rds.results_df = (rds.results_df.merge(st.session_state['annotations'],
                                                        how='left', on=rds.gene_id))
+                rds.index_results()
         st.session_state['results_ds'] = rds
 
     if st.button('Clear loaded fitness data', key='res_button') and 'results_ds' in st.session_state.keys():
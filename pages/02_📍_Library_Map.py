@@ -3,7 +3,6 @@ import pandas as pd
 import streamlit as st
 from scripts.datasets import LibraryMap, convert_df
 from scripts.graphs import define_color_scheme
-#import dash_bio
 st.set_page_config(layout='wide')
 
 
@@ -22,8 +21,11 @@ def app():
             - `insertion_site`
             - `chr`
             - `distance_to_feature`
-        - You can load more than one library file at the same time to compare.
+        - You can load more than one library file at the same time to compare. The number of barcodes shared between libraries is shown below the insertion summary, and barcodes mapped to more than one insertion site can be downloaded.
         - You can select which sequence (e.g. chromosome or plasmids) to display, and color the insertions by the library (if multiple files are loaded), or whether the insertion is inside a CDS.
+        - For large maps, use **Genome Track**: zoomed out, it shows the maximum and mean abundance per genomic window; individual insertions are drawn once the visible range contains few enough of them.
+        - On the **Coverage Histogram**, the longest insertion-free regions of the sequence can be highlighted, listed together with the genes they overlap, and downloaded.
+        - The **Needle Plot** shows the insertions within a single gene, drawn over the gene coordinates.
         - You can click on the figure legend to only show a specific subset of data (i.e. if looking at multiple libraries, double-clicking on the specific library name will show data for that library only).
         
         """)
@@ -62,39 +64,72 @@ def app():
             lm.get_stats()
             st.markdown("#### Insertion Summary")
             st.table(lm.stats)
+            if lm.lib_map['library'].nunique() > 1:
+                st.markdown("#### Barcodes shared between libraries")
+                st.table(lm.get_barcode_overlap())
+                collisions = lm.get_barcode_collisions()
+                if not collisions.empty:
+                    st.warning(f"⚠️ {len(collisions)} barcodes map to more than one insertion site")
+                    st.download_button(
+                        label="Download barcode collisions as CSV",
+                        data=convert_df(collisions),
+                        file_name='barcode_collisions.csv',
+                        mime='text/csv',
+                    )
         # Graph coverage map or individual insertion abundance
         with st.container():
             # Define colors
             colors, alphabetClrs, all_clrs = define_color_scheme()
-            graph_type = st.radio("Choose graph", ['Coverage Histogram', 'Individual Insertions'])
+            graph_type = st.radio("Choose graph", ['Coverage Histogram', 'Individual Insertions', 'Genome Track'])
             c1, c2, c3 = st.columns(3)
             chr_col_choice = c1.selectbox('Choose sequence to display', lm.lib_map[lm.chr_col].unique())
+            gaps = None
             if graph_type == 'Individual Insertions':
                 color_by_choice = c2.selectbox('Color by', lm.color_by_cols)
                 fig = lm.graph_insertions(chr_col_choice, color_by_choice, all_clrs)
+            elif graph_type == 'Genome Track':
+                color_by_choice = c2.selectbox('Color by', lm.color_by_cols)
+                chr_start, chr_end = lm.get_position_range(chr_col_choice)
+                track_start, track_end = c3.slider('Visible range, bp', min_value=chr_start,
+                                                   max_value=max(chr_end, chr_start + 1),
+                                                   value=(chr_start, max(chr_end, chr_start + 1)))
+                fig = lm.graph_insertion_track(chr_col_choice, track_start, track_end, color_by_choice, all_clrs)
             else:
                 try:
                     num_bins = c2.number_input('Number of bins', value=100, min_value=10, max_value=1000)
                     hist_col = c3.text_input('Color (hex, rgb, hsl, hsv or color name)', value=colors['teal'])
-                    fig = lm.graph_coverage_hist(chr_col_choice, num_bins, hist_col)
+                    g1, g2, g3 = st.columns(3)
+                    if g1.checkbox('Highlight insertion-free regions'):
+                        min_gap = g2.number_input('Minimum region length, bp', value=1000, min_value=1)
+                        max_gaps = g3.number_input('Number of regions', value=20, min_value=1, max_value=1000)
+                        gaps = lm.get_insertion_gaps(chr_col_choice, min_gap, max_gaps)
+                    fig = lm.graph_coverage_hist(chr_col_choice, num_bins, hist_col, gaps)
                 except ValueError:
                     st.write("Please enter a valid color. The following formats are accepted: hex, rgb, hsl, hsv or color name")
                     return
 
             st.plotly_chart(fig, use_container_width=True)
+            if gaps is not None:
+                st.markdown('#### Insertion-free regions')
+                st.dataframe(gaps)
+                st.download_button(
+                    label="Download insertion-free regions",
+                    data=convert_df(gaps),
+                    file_name=f'insertion_free_regions_{chr_col_choice}.csv',
+                    mime='text/csv',
+                )
 
-#    with st.container():
-#        st.subheader('Needle Plot')
-#        co1, co2, co3 = st.columns(3)
-#        gene_choice = co1.selectbox('Choose gene to display', lm.lib_map["Name"].unique())
-
-#        test = dash_bio.NeedlePlot(
-#            id='dashbio-default-needleplot',
-#            mutationData={'x': ['50', '175'], 'y': ['1', '1'], 'mutationGroups': ['Insert', 'Insert'],
-#                          'domains': [{'name': 'Gene1', 'coord': '1-100'},
-#                                      {'name': 'Gene2', 'coord': '150-200'}]}
-#        )
-#        st.plotly_chart(test)
+    # Insertions within a single gene
+    if lm.attributes:
+        with st.container():
+            st.subheader('Needle Plot')
+            co1, co2, co3 = st.columns(3)
+            gene_col = co1.selectbox('Gene identifier', lm.attributes,
+                                     index=lm.attributes.index('Name') if 'Name' in lm.attributes else 0)
+            gene_choice = co2.selectbox('Choose gene to display', lm.get_genes_with_insertions(gene_col))
+            needle_color_by = co3.selectbox('Color by', lm.color_by_cols, key='needle_color_by')
+            fig = lm.graph_needle(gene_choice, gene_col, needle_color_by, all_clrs)
+            st.plotly_chart(fig, use_container_width=True)
 
 app()
 
@@ -1,7 +1,7 @@
 import streamlit as st
-from scripts.datasets import CountDataSet, convert_df, define_color_scheme
+from scripts.datasets import CountDataSet, GENE_AGGREGATIONS, NORMALIZATION_METHODS, convert_df, define_color_scheme
 import pandas as pd
-from scripts.layouts import pca_layout, barcode_abundance_layout
+from scripts.layouts import pca_layout, correlation_layout, barcode_abundance_layout
 from pathlib import Path
 st.set_page_config(layout='wide')
 
@@ -45,8 +45,10 @@ def app():
         st.markdown("""
 
         - The merged count table produced by `mbarq` will contain barcodes found in the mapping file, as well as unannotated barcodes (e.g. control spike-ins, artifacts). Only annotated barcodes are used for the exploratory analysis.
-        - Simple TSS normalization and log2 transformation are performed.
+        - Counts are normalized (TSS/CPM by default; upper quartile, TMM, median-of-ratios and CLR are also available) and log2 transformed. Switching back to a method you already used does not recompute it.
         - For PCA plot, you can choose how many barcodes are used for the analysis, as well as which components to visualize. The scree plot shows the % of variance explained by each of the PCs. 
+        - Analyses can run on barcodes or on genes, with counts aggregated over each gene's barcodes (sum, median, or number of counted barcodes).
+        - Sample Correlation shows Pearson or Spearman correlations between samples, ordered by hierarchical clustering, for replicate QC.
         - For Barcode Abundance, normalized barcode counts can be visualized for any gene of interest and compared across different sample data variables. 
         """)
 
@@ -82,13 +84,28 @@ def app():
                 file_name='example_sample_data_file.csv',
                 mime='text/csv',
             )
-            cds = CountDataSet(cfile, mfile)
+            # Kept across reruns so normalizations already computed for the example data are reused
+            if 'example_count_ds' not in st.session_state.keys():
+                st.session_state['example_count_ds'] = CountDataSet(cfile, mfile)
+            cds = st.session_state['example_count_ds']
         # IF DATA IS LOADED VISUALIZE
         if cds.valid:
-            cds.normalize_counts()
+            n1, n2, n3 = st.columns(3)
+            level = n1.radio('Analysis level', ['Barcodes', 'Genes'], horizontal=True,
+                             help='Gene level aggregates the counts of all barcodes of each gene')
+            if level == 'Genes':
+                aggregation = n2.selectbox('Aggregate barcodes by', GENE_AGGREGATIONS,
+                                           format_func=lambda a: a.replace('_', ' '))
+                cds = cds.get_gene_level(aggregation)
+            methods = list(NORMALIZATION_METHODS.keys())
+            norm_method = n3.selectbox('Normalization method', methods, index=methods.index(cds.norm_method),
+                                       format_func=lambda m: f'{m} ({NORMALIZATION_METHODS[m]})')
+            cds.normalize_counts(norm_method)
             st.write('## PCA plot')
             # PCA GRAPH
             pca_layout(cds)
+            # SAMPLE CORRELATION
+            correlation_layout(cds)
             # BARCODE ABUNDANCE
             barcode_abundance_layout(cds)
 app()
\ No newline at end of file
@@ -62,14 +62,18 @@ def app():
             lfc_hi = lfc_col2.number_input('Max Log FC',  step=0.5, value=-1.0)
 
         rds.identify_hits(library_to_show,  lfc_low, lfc_hi, fdr_th)
-        fig = rds.graph_by_rank(contrast=contrast_to_show, kegg=False)
+        webgl = st.checkbox('Fast rank plot', value=len(rds.results_df) > rds.rank_webgl_min_points,
+                            help=f'Draw with WebGL, showing all hits and the {rds.rank_extreme_points} genes at '
+                                 f'either end, but at most {rds.rank_max_points} of the other genes')
+        fig = rds.graph_by_rank(contrast=contrast_to_show, kegg=False, webgl=webgl)
         st.plotly_chart(fig, use_container_width=True)
         st.subheader('Fitness heatmaps')
         gene_options = rds.results_df[rds.gene_id].unique()
         defaults = [g for g in ['rfaB', 'rfaC', 'rfaG', 'rfaI', 'hilC', 'hilD'] if g in gene_options]
         genes = st.multiselect('Choose genes of interest', gene_options, default=defaults)
+        cluster = st.checkbox('Cluster genes and contrasts')
         if genes:
-            fig = rds.graph_heatmap(genes)
+            fig = rds.graph_heatmap(genes, cluster=cluster)
             st.plotly_chart(fig, use_container_width=True)
 
 
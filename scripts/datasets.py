@@ -1,12 +1,24 @@
 from pathlib import Path
 from typing import List, Union
+import copy
+import hashlib
+import io
+import shutil
+import time
 import pandas as pd
 import pandera as pa
 import plotly.express as px
+import plotly.graph_objects as go
+from plotly.subplots import make_subplots
 import streamlit as st
 import yaml
 from pandera.errors import SchemaError
+from pandas._libs import hashtable
 import numpy as np
+from scipy import sparse
+from scipy.cluster import hierarchy
+from scipy.spatial.distance import pdist, squareform
+from scipy.stats import rankdata
 from sklearn.decomposition import PCA
 from Bio.KEGG.REST import *
 from Bio.KEGG.KGML import KGML_parser
@@ -45,7 +57,293 @@ def define_color_scheme():
     return alphabet_clrs, app_colors, all_clrs
 
 
+VALIDATION_MODES = ('full', 'fast', 'sampled')
+COUNT_STORAGE_MODES = ('sparse', 'dense')
+CORRELATION_METHODS = ('pearson', 'spearman')
+GENE_AGGREGATIONS = ('sum', 'median', 'barcode_count')
+HEATMAP_CLUSTER_METRICS = ('euclidean', 'correlation')
+# Normalization method -> name of the normalized value column
+NORMALIZATION_METHODS = {'cpm': 'log2CPM',
+                         'upper_quartile': 'log2CPM (upper quartile)',
+                         'tmm': 'log2CPM (TMM)',
+                         'median_ratio': 'log2 median-of-ratios counts',
+                         'clr': 'CLR'}
+
+
+def read_upload_bytes(uploaded_file) -> bytes:
+    """
+    Return raw contents of a Streamlit UploadedFile or of a file path
+    """
+    if hasattr(uploaded_file, 'getvalue'):
+        return uploaded_file.getvalue()
+    return Path(uploaded_file).read_bytes()
+
+
+def concat_categorical(dfs: List[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Concatenate data frames, keeping categorical columns categorical by unifying their categories first
+    (pd.concat falls back to object columns when the categories differ)
+    """
+    cat_cols = {c for df in dfs for c in df.columns if isinstance(df[c].dtype, pd.CategoricalDtype)}
+    for col in cat_cols:
+        categories = pd.Index([])
+        for df in dfs:
+            if col in df.columns:
+                categories = categories.union(df[col].astype('category').cat.categories)
+        for df in dfs:
+            if col in df.columns:
+                df[col] = df[col].astype('category').cat.set_categories(categories)
+    concat_df = pd.concat(dfs, ignore_index=True)
+    return concat_df.astype({c: 'category' for c in cat_cols})
+
+
+def count_unique_per_group(group_codes: np.ndarray, value_codes: np.ndarray, n_groups: int) -> np.ndarray:
+    """
+    Number of distinct values per group, given integer codes (negative value codes mark missing values).
+    Marks (group, value) pairs in a boolean table instead of sorting, so it is linear in the number of rows.
+    """
+    valid = value_codes >= 0
+    group_codes, value_codes = group_codes[valid].astype(np.int64), value_codes[valid]
+    n_values = int(value_codes.max()) + 1 if value_codes.size else 1
+    seen = np.zeros(n_groups * n_values, dtype=bool)
+    seen[group_codes * n_values + value_codes] = True
+    return seen.reshape(n_groups, n_values).sum(axis=1)
+
+
+def bin_sorted_positions(sorted_positions: np.ndarray, bin_edges: np.ndarray) -> np.ndarray:
+    """
+    Count sorted positions falling into each bin, with one binary search per bin edge.
+    Bins are half-open except the last one, which includes the right edge (as in np.histogram).
+    """
+    boundaries = np.searchsorted(sorted_positions, bin_edges, side='left')
+    boundaries[-1] = np.searchsorted(sorted_positions, bin_edges[-1], side='right')
+    return np.diff(boundaries)
+
+
+def sparse_column_quantiles(matrix: sparse.csc_matrix, q: float, implicit_zeros: np.ndarray) -> np.ndarray:
+    """
+    q-th quantile of each column of a CSC matrix (linear interpolation, as np.quantile), where each column also
+    holds implicit_zeros zeros that are not stored. Stored values are sorted within their column with one lexsort;
+    zeros must rank below the stored values, so pass implicit zeros only for non-negative data.
+    """
+    stored = np.diff(matrix.indptr)
+    columns = np.repeat(np.arange(matrix.shape[1]), stored)
+    values = matrix.data[np.lexsort((matrix.data, columns))]
+    position = q * (stored + implicit_zeros - 1)
+
+    def value_at(rank):
+        stored_rank = rank - implicit_zeros
+        index = np.minimum(matrix.indptr[:-1] + np.maximum(stored_rank, 0), max(values.size - 1, 0))
+        return np.where(stored_rank >= 0, values[index] if values.size else 0, 0)
+
+    low, high = np.floor(position).astype(np.int64), np.ceil(position).astype(np.int64)
+    return value_at(low) + (position - low) * (value_at(high) - value_at(low))
+
+
+def column_quantiles(counts, q: float, positive_only: bool = False) -> np.ndarray:
+    """
+    q-th quantile of each sample's counts over barcodes with at least one count in any sample,
+    or over the sample's positive counts only
+    """
+    if sparse.issparse(counts):
+        counts = counts.tocsc()
+        implicit_zeros = (np.zeros(counts.shape[1], dtype=np.int64) if positive_only
+                          else np.count_nonzero(counts.getnnz(axis=1)) - counts.getnnz(axis=0))
+        return sparse_column_quantiles(counts, q, implicit_zeros)
+    if positive_only:
+        return np.array([np.quantile(col[col > 0], q) if col.any() else 0 for col in counts.T])
+    return np.quantile(counts[counts.any(axis=1)], q, axis=0)
+
+
+def trim_mask(values: np.ndarray, trim: float) -> np.ndarray:
+    """
+    Per column, mask of the non-NaN values left after trimming the lowest and highest trim fraction of them
+    """
+    n_valid = np.count_nonzero(~np.isnan(values), axis=0)
+    ranks = np.empty(values.shape, dtype=np.int64)
+    # argsort puts NaNs last, so they rank above every valid value
+    np.put_along_axis(ranks, np.argsort(values, axis=0), np.arange(1, values.shape[0] + 1)[:, None], axis=0)
+    low = np.floor(n_valid * trim) + 1
+    return (ranks >= low) & (ranks <= n_valid + 1 - low)
+
+
+def median_ratio_size_factors(counts) -> np.ndarray:
+    """
+    DESeq2 median-of-ratios size factors: per sample, the median ratio of its counts to each barcode's geometric
+    mean across samples, over barcodes counted in every sample. If no barcode is counted in every sample,
+    geometric means and medians are taken over positive counts only (DESeq2 'poscounts').
+    """
+    n_samples = counts.shape[1]
+    counted = counts.getnnz(axis=1) if sparse.issparse(counts) else np.count_nonzero(counts, axis=1)
+    if (counted == n_samples).any():
+        complete = counts[counted == n_samples]
+        log_counts = np.log(complete.toarray() if sparse.issparse(complete) else complete)
+        log_factors = np.median(log_counts - log_counts.mean(axis=1, keepdims=True), axis=0)
+    else:
+        log_ratios = sparse.csr_matrix(counts, dtype=np.float64)
+        log_ratios.eliminate_zeros()
+        np.log(log_ratios.data, out=log_ratios.data)
+        row_means = np.asarray(log_ratios.sum(axis=1)).ravel() / n_samples
+        log_ratios.data -= np.repeat(row_means, np.diff(log_ratios.indptr))
+        log_factors = column_quantiles(log_ratios, 0.5, positive_only=True)
+    return np.exp(log_factors - log_factors.mean())
+
+
+def upper_quartile_factors(counts, library_sizes: np.ndarray) -> np.ndarray:
+    """
+    edgeR upper-quartile normalization factors: 75th percentile of each sample's counts over barcodes with
+    at least one count, relative to library size, scaled to a geometric mean of 1.
+    Samples whose upper quartile is zero (common in sparse tables) use the quartile of their positive counts.
+    """
+    upper_quartiles = column_quantiles(counts, 0.75)
+    if not upper_quartiles.all():
+        upper_quartiles = np.where(upper_quartiles > 0, upper_quartiles,
+                                   column_quantiles(counts, 0.75, positive_only=True))
+    factors = upper_quartiles / library_sizes
+    return factors / np.exp(np.log(factors).mean())
+
+
+def tmm_factors(counts, library_sizes: np.ndarray, logratio_trim: float = 0.3, sum_trim: float = 0.05) -> np.ndarray:
+    """
+    edgeR TMM normalization factors, for all samples at once against the reference sample whose upper quartile
+    is closest to the mean: precision-weighted mean of log ratios (M) over barcodes counted in both samples,
+    after trimming the most extreme M and mean log abundances (A). Scaled to a geometric mean of 1.
+    """
+    upper_quartiles = upper_quartile_factors(counts, library_sizes)
+    ref = int(np.argmin(np.abs(upper_quartiles - upper_quartiles.mean())))
+    ref_counts = counts[:, [ref]]
+    ref_counts = ref_counts.toarray().ravel() if sparse.issparse(ref_counts) else ref_counts.ravel()
+    observed = counts[np.flatnonzero(ref_counts)]
+    observed = (observed.toarray() if sparse.issparse(observed) else observed).astype(np.float64)
+    ref_counts = observed[:, [ref]]
+    sizes = library_sizes.astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_observed = np.log2(observed / sizes)
+        log_ref = np.log2(ref_counts / sizes[ref])
+        m_values = log_observed - log_ref
+        a_values = (log_observed + log_ref) / 2
+        variances = (sizes - observed) / sizes / observed + (sizes[ref] - ref_counts) / sizes[ref] / ref_counts
+        m_values[observed == 0] = np.nan
+        a_values[observed == 0] = np.nan
+        weights = np.where(trim_mask(m_values, logratio_trim) & trim_mask(a_values, sum_trim), 1 / variances, 0)
+        log_factors = (np.nan_to_num(m_values) * weights).sum(axis=0) / weights.sum(axis=0)
+    # Samples without any barcode left after trimming keep a factor of 1
+    factors = 2 ** np.nan_to_num(log_factors)
+    return factors / np.exp(np.log(factors).mean())
+
+
+def column_correlation(matrix, offset: np.ndarray, block_values: int = 2 ** 22) -> np.ndarray:
+    """
+    Pearson correlation between the columns of matrix + offset (the offset is added to every row of its column),
+    from one Gram product X'X that is centered and scaled afterwards, which equals the product of the standardized
+    columns. Sparse matrices stay sparse, with the offset folded in analytically; dense ones are multiplied in
+    row blocks of block_values values. Accumulates in float64.
+    """
+    n_rows, n_cols = matrix.shape
+    if sparse.issparse(matrix):
+        matrix = matrix.astype(np.float64)
+        gram = (matrix.T @ matrix).toarray()
+        col_sums = np.asarray(matrix.sum(axis=0)).ravel()
+    else:
+        gram, col_sums = np.zeros((n_cols, n_cols)), np.zeros(n_cols)
+        block_size = max(1, block_values // max(n_cols, 1))
+        for start in range(0, n_rows, block_size):
+            block = matrix[start:start + block_size].astype(np.float64)
+            gram += block.T @ block
+            col_sums += block.sum(axis=0)
+    offset = np.asarray(offset, dtype=np.float64)
+    gram += np.outer(col_sums, offset) + np.outer(offset, col_sums) + n_rows * np.outer(offset, offset)
+    sums = col_sums + n_rows * offset
+    covariance = gram - np.outer(sums, sums) / n_rows
+    scale = np.sqrt(np.maximum(np.diag(covariance), 0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.clip(covariance / np.outer(scale, scale), -1, 1)
+
+
+def rank_columns(matrix):
+    """
+    Average ranks of each column's values, for Spearman correlation. Sparse matrices must hold positive values:
+    the implicit zeros share one tied rank, which becomes the per-column offset so the ranked matrix stays sparse.
+    :return: ranked matrix, per-column offset
+    """
+    if not sparse.issparse(matrix):
+        return rankdata(matrix, axis=0).astype(np.float32), np.zeros(matrix.shape[1])
+    ranked = matrix.tocsc().astype(np.float64)
+    n_zeros = matrix.shape[0] - np.diff(ranked.indptr)
+    zero_ranks = (n_zeros + 1) / 2
+    for col in range(ranked.shape[1]):
+        segment = slice(ranked.indptr[col], ranked.indptr[col + 1])
+        ranked.data[segment] = rankdata(ranked.data[segment]) + n_zeros[col] - zero_ranks[col]
+    return ranked.tocsr(), zero_ranks
+
+
+def summarize_distribution(values: np.ndarray, kde_points: int = 100, kde_bins: int = 512) -> dict:
+    """
+    Box plot statistics (quartiles, Tukey whiskers, mean) and a Gaussian KDE curve for one group of values.
+    The KDE bins the values and convolves the histogram with the kernel, so it is linear in the number of values;
+    bandwidth follows Silverman's rule and the curve spans two bandwidths past the data, as in plotly violins.
+    """
+    q1, median, q3 = np.quantile(values, [0.25, 0.5, 0.75])
+    iqr = q3 - q1
+    std = values.std(ddof=1) if values.size > 1 else 0
+    bandwidth = 1.059 * min(std, iqr / 1.349) * values.size ** -0.2
+    if not bandwidth > 0:
+        bandwidth = std if std > 0 else 1e-3
+    low, high = values.min() - 2 * bandwidth, values.max() + 2 * bandwidth
+    histogram, edges = np.histogram(values, bins=kde_bins, range=(low, high))
+    step = edges[1] - edges[0]
+    half_width = int(min(np.ceil(4 * bandwidth / step), kde_bins))
+    kernel = np.exp(-0.5 * (np.arange(-half_width, half_width + 1) * step / bandwidth) ** 2)
+    density = np.convolve(histogram, kernel, mode='full')[half_width:half_width + kde_bins]
+    density = density / (values.size * bandwidth * np.sqrt(2 * np.pi))
+    kde_y = np.linspace(low, high, kde_points)
+    return {'q1': q1, 'median': median, 'q3': q3, 'mean': values.mean(),
+            'lowerfence': values[values >= q1 - 1.5 * iqr].min(),
+            'upperfence': values[values <= q3 + 1.5 * iqr].max(),
+            'kde_y': kde_y, 'kde_density': np.interp(kde_y, (edges[:-1] + edges[1:]) / 2, density)}
+
+
+def dendrogram_lines(linkage: np.ndarray):
+    """
+    Leaf order and the links of a dendrogram as one polyline, links separated by NaN, so it can be drawn as a
+    single trace. Leaf coordinates are rescaled to the positions 0, 1, 2... of the leaves.
+    :return: leaf order, leaf-axis coordinates, height coordinates
+    """
+    dendrogram = hierarchy.dendrogram(linkage, no_plot=True)
+    gap = np.full((len(dendrogram['icoord']), 1), np.nan)
+    # scipy puts leaves at 5, 15, 25...
+    leaf_coords = np.hstack([(np.array(dendrogram['icoord']) - 5) / 10, gap]).ravel()
+    heights = np.hstack([np.array(dendrogram['dcoord']), gap]).ravel()
+    return np.array(dendrogram['leaves']), leaf_coords, heights
+
+
+def decimate_ranks(keep: np.ndarray, n_extremes: int, max_middle: int) -> np.ndarray:
+    """
+    Positions to draw from a rank-ordered series: every position flagged in keep, the n_extremes first and last,
+    and at most max_middle evenly spaced positions from the rest
+    """
+    n_points = keep.size
+    keep = keep.copy()
+    keep[:n_extremes] = True
+    keep[max(n_points - n_extremes, 0):] = True
+    middle = np.flatnonzero(~keep)
+    if middle.size > max_middle:
+        middle = middle[np.linspace(0, middle.size - 1, max_middle).astype(np.int64)]
+    keep[middle] = True
+    return np.flatnonzero(keep)
+
+
+def sample_id_from_count_file(count_file) -> str:
+    """
+    Sample ID of a per-sample mbarq count file (ex. dnaid1315_10_mbarq_counts.csv -> dnaid1315_10)
+    """
+    file_name = count_file.name if hasattr(count_file, 'name') else str(count_file)
+    return Path(file_name).name.split('_mbarq')[0].split('.csv')[0]
+
+
 class LibraryMap:
+    # Bump when the layout of the cached map frames changes
+    MAP_CACHE_VERSION = 3
 
     def __init__(self, map_files: List = (),
                  map_df: pd.DataFrame = pd.DataFrame(),
@@ -68,63 +366,363 @@ class LibraryMap:
         self.abundance_col = col_name_config['abundance_col']
         self.barcode_col = col_name_config['barcode_col']
         self.distance_col = col_name_config['distance_col']
+        self.library_col = col_name_config['library_col']
+        self.gene_start_col = opt_name_config['gene_start_col']
+        self.gene_end_col = opt_name_config['gene_end_col']
+        self.strand_col = opt_name_config['strand_col']
+        self.percentile_col = opt_name_config['percentile_col']
+        # Compact dtypes for the fixed columns; other text columns are stored as categories.
+        # Barcodes are categorical too: integer codes into one barcode dictionary shared by all loaded maps
+        self.column_dtypes = {col_name_config[c]: dtype for c, dtype in config['column_dtypes'].items()}
+        self.chunksize = config['chunksize']
+        # full: pandera schema on every row, fast: numpy dtype/range checks only,
+        # sampled: pandera schema on a random subset plus range checks on every row
+        self.validation_mode = config['validation']['mode']
+        self.validation_sample_size = config['validation']['sample_size']
+        if self.validation_mode not in VALIDATION_MODES:
+            raise ValueError(f"Unknown validation mode {self.validation_mode}, choose one of {VALIDATION_MODES}")
+        self.validation_time = 0.0
+        # Genome track: multi-resolution tiles per sequence, built on first use
+        self.track_config = config['track']
+        self.track_pyramids = {}
+        # Position index: sorted insertion sites and row offsets per sequence, built after validation
+        self.positions = None
+        self.chr_offsets = {}
+        # Incremented whenever a new map is indexed; derived tables are cached against it
+        self.map_version = 0
+        self._stats_key = None
+        self._barcode_presence = (None, None)
+        self._barcode_collisions = (None, None)
+        self._gene_index = {}
+        # Validated maps are cached on disk, keyed on a hash of the uploaded file contents
+        self.cache_dir = Path(config['cache']['cache_dir'])
+        self.max_cached_maps = config['cache']['max_cached_maps']
+        self.map_hash = ''
+        self.validated = False
 
     def load_map(self):
         map_dfs = []
         if self.map_files:
+            raw_maps = []
+            map_key = hashlib.sha256(f"{self.MAP_CACHE_VERSION}:{self.fixed_column_names}:{self.validation_mode}:"
+                                     f"{self.column_dtypes}".encode())
             for uploaded_map in self.map_files:
                 st.write(f"_Processing {uploaded_map.name}_")
-                df, df_name = pd.read_csv(uploaded_map), uploaded_map.name
-                if 'library' not in df.columns:
+                raw_map, df_name = read_upload_bytes(uploaded_map), uploaded_map.name
+                map_columns = list(pd.read_csv(io.BytesIO(raw_map), nrows=0).columns)
+                library_name = None
+                if 'library' not in map_columns:
                     library_name = st.text_input("Change library name?", value=df_name)
-                    df['library'] = library_name
-                missing_cols = [c for c in self.fixed_column_names if c not in df.columns]
+                    map_columns.append('library')
+                missing_cols = [c for c in self.fixed_column_names if c not in map_columns]
                 if len(missing_cols) > 0:
                     st.markdown(
                         f"""⚠️ The following columns are missing from the map files: {', '.join(missing_cols)}. 
                                     Please rename the columns/rerun mBARq and try again. Skipping {df_name} ⚠️""")
                     continue
-                map_dfs.append(df)
-            try:
-                self.lib_map = pd.concat(map_dfs)
-            except ValueError:
-                st.error("No library map loaded")
-        if not self.lib_map.empty:
+                map_key.update(raw_map)
+                map_key.update(str(library_name).encode())
+                raw_maps.append((raw_map, library_name))
+            if raw_maps:
+                self.map_hash = map_key.hexdigest()
+                cached_map = self._read_cached_map()
+                if cached_map is not None:
+                    self.lib_map = cached_map
+                    self.validated = True
+            if not self.validated:
+                self.validation_time = 0.0
+                failed_maps = 0
+                for raw_map, library_name in raw_maps:
+                    try:
+                        map_dfs.extend(self._ingest_map(raw_map, library_name))
+                    except (SchemaError, ValueError) as err:
+                        failed_maps += 1
+                        st.error(f"""Schema Error: {err.args[0]}""")
+                try:
+                    self.lib_map = concat_categorical(map_dfs)
+                    self.validated = True
+                    st.write(f"_Validated library map in {self.validation_time:.2f} s ({self.validation_mode} mode)_")
+                    self.build_position_index()
+                    # The cache key covers every uploaded file; a map missing the failed ones must not be served
+                    # for it, or the schema errors would not be shown again
+                    if not failed_maps:
+                        self._write_cached_map()
+                except ValueError:
+                    st.error("No library map loaded")
+        if not self.lib_map.empty and not self.validated:
             self.lib_map['in CDS'] = self.lib_map[self.distance_col] == 0
         self.attributes = [c for c in self.lib_map.columns if c not in self.fixed_column_names
                            and c not in self.optional_column_names + ['library', 'in CDS']]
 
-    def validate_lib_map(self):
-        lib_schema = pa.DataFrameSchema({
-            self.chr_col: pa.Column(str, coerce=True),
-            self.insertion_site_col: pa.Column(int, pa.Check(lambda x: x >= 0)),
-            self.barcode_col: pa.Column(str, coerce=True),
-            self.abundance_col: pa.Column(int, pa.Check(lambda x: x >= 0)),
-            self.distance_col: pa.Column(int, coerce=True, nullable=True),
+    def _ingest_map(self, raw_map: bytes, library_name: Union[str, None]) -> List[pd.DataFrame]:
+        """
+        Stream one map file in chunks, validating each chunk and converting it to compact dtypes,
+        so that at most one chunk is held with inferred (wide) dtypes at a time
+        """
+        read_dtypes = {self.chr_col: 'category', self.library_col: 'category', self.barcode_col: 'category'}
+        map_chunks = []
+        for chunk in pd.read_csv(io.BytesIO(raw_map), dtype=read_dtypes, chunksize=self.chunksize):
+            if library_name is not None:
+                chunk['library'] = library_name
+            chunk['in CDS'] = chunk[self.distance_col] == 0
+            map_chunks.append(self._compact_map(self._validate_map_frame(chunk)))
+        return map_chunks
+
+    def _validate_map_frame(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Validate (part of) a library map according to validation_mode, adding the time spent to validation_time
+
+        :raises SchemaError: if the pandera schema fails (full and sampled modes)
+        :raises ValueError: if a dtype or range check fails (fast and sampled modes)
+        """
+        start_time = time.perf_counter()
+        try:
+            if self.validation_mode == 'full':
+                return self._lib_map_schema().validate(df)
+            if self.validation_mode == 'sampled':
+                self._lib_map_schema().validate(df.sample(n=min(self.validation_sample_size, len(df)),
+                                                          random_state=0))
+            return self._check_map_frame(df)
+        finally:
+            self.validation_time += time.perf_counter() - start_time
+
+    def _check_map_frame(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Fast counterpart of the pandera schema: dtype checks plus one min/max reduction per numeric column
+        """
+        missing_cols = [c for c in [self.chr_col, self.barcode_col, 'library', 'in CDS'] + list(self.column_dtypes)
+                        if c not in df.columns]
+        if missing_cols:
+            raise ValueError(f"Missing columns: {', '.join(missing_cols)}")
+        for col in [self.insertion_site_col, self.abundance_col, self.distance_col]:
+            if col == self.distance_col and pd.api.types.is_numeric_dtype(df[col]):
+                min_value = np.iinfo(self.column_dtypes[col]).min
+            elif pd.api.types.is_integer_dtype(df[col]):
+                min_value = 0
+            else:
+                raise ValueError(f"Column '{col}' should contain integers, found {df[col].dtype}")
+            max_value = np.iinfo(self.column_dtypes[col]).max
+            if len(df) and (df[col].min() < min_value or df[col].max() > max_value):
+                raise ValueError(f"Column '{col}' has values outside of [{min_value}, {max_value}]")
+        for col in [self.chr_col, self.barcode_col, 'library']:
+            if df[col].isna().any():
+                raise ValueError(f"Column '{col}' has missing values")
+        if not pd.api.types.is_bool_dtype(df['in CDS']):
+            raise ValueError(f"Column 'in CDS' should be boolean, found {df['in CDS'].dtype}")
+        return df
+
+    def _compact_map(self, df: pd.DataFrame) -> pd.DataFrame:
+        df = df.astype({c: dtype for c, dtype in self.column_dtypes.items() if c in df.columns})
+        text_cols = df.select_dtypes(include=['object', 'string']).columns
+        return df.astype({c: 'category' for c in text_cols})
+
+    def _lib_map_schema(self) -> pa.DataFrameSchema:
+        """
+        Numeric columns are range checked against their compact dtypes before being downcast,
+        since numpy casts wrap around silently
+        """
+        def in_dtype_range(col, min_value=None):
+            dtype_info = np.iinfo(self.column_dtypes[col])
+            return pa.Check.in_range(dtype_info.min if min_value is None else min_value, dtype_info.max)
+
+        return pa.DataFrameSchema({
+            self.chr_col: pa.Column('category', coerce=True),
+            self.insertion_site_col: pa.Column(int, in_dtype_range(self.insertion_site_col, 0)),
+            self.barcode_col: pa.Column('category', coerce=True),
+            self.abundance_col: pa.Column(int, in_dtype_range(self.abundance_col, 0)),
+            self.distance_col: pa.Column(int, in_dtype_range(self.distance_col), coerce=True, nullable=True),
             'in CDS': pa.Column(bool),
-            'library': pa.Column(str, coerce=True)
+            'library': pa.Column('category', coerce=True)
         }
         )
+
+    def _cached_map_path(self) -> Path:
+        return self.cache_dir / f"{self.map_hash}.parquet"
+
+    def _read_cached_map(self) -> Union[pd.DataFrame, None]:
+        """
+        Load a previously validated map with the same content hash, if there is one
+        """
+        cache_path = self._cached_map_path()
+        if not cache_path.exists():
+            return None
         try:
-            self.lib_map = lib_schema.validate(self.lib_map)
+            cached_map = pd.read_parquet(cache_path)
+        except (ImportError, OSError, ValueError):
+            return None
+        cache_path.touch()
+        return cached_map
 
-        except SchemaError as err:
-            st.error(f"""Schema Error: {err.args[0]}""")
-            self.lib_map = pd.DataFrame()
+    def _write_cached_map(self):
+        """
+        Store the validated map as Parquet and evict the least recently used entries.
+        Caching is best effort: a missing parquet engine or a read-only disk only costs the speed-up.
+        """
+        if not self.map_hash or self.lib_map.empty:
+            return
+        cache_path = self._cached_map_path()
+        tmp_path = cache_path.with_suffix('.tmp')
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            self.lib_map.to_parquet(tmp_path, index=False)
+            tmp_path.replace(cache_path)
+            cached_maps = sorted(self.cache_dir.glob('*.parquet'), key=lambda f: f.stat().st_mtime, reverse=True)
+            for stale_map in cached_maps[self.max_cached_maps:]:
+                stale_map.unlink(missing_ok=True)
+        except (ImportError, OSError, ValueError):
+            tmp_path.unlink(missing_ok=True)
+
+    def validate_lib_map(self):
+        if not self.validated:
+            self.validation_time = 0.0
+            try:
+                self.lib_map = self._compact_map(self._validate_map_frame(self.lib_map))
+            except (SchemaError, ValueError) as err:
+                st.error(f"""Schema Error: {err.args[0]}""")
+                self.lib_map = pd.DataFrame()
+                return
+            self.validated = True
+            st.write(f"_Validated library map in {self.validation_time:.2f} s ({self.validation_mode} mode)_")
+            self.build_position_index()
+            self._write_cached_map()
+        elif self.positions is None:
+            self.build_position_index()
+
+    def build_position_index(self):
+        """
+        Sort the map by sequence and insertion site once (skipped if it already is, e.g. when loaded from cache)
+        and keep the sites as one contiguous array with row offsets per sequence,
+        so that sequence selection and range queries become slices found by binary search
+        """
+        chr_codes = self.lib_map[self.chr_col].cat.codes.to_numpy()
+        positions = self.lib_map[self.insertion_site_col].to_numpy()
+        chr_steps, position_steps = np.diff(chr_codes), np.diff(positions)
+        if not np.all((chr_steps > 0) | ((chr_steps == 0) & (position_steps >= 0))):
+            order = np.lexsort((positions, chr_codes))
+            self.lib_map = self.lib_map.iloc[order].reset_index(drop=True)
+            chr_codes, positions = chr_codes[order], positions[order]
+        chr_names = self.lib_map[self.chr_col].cat.categories
+        chr_bounds = np.searchsorted(chr_codes, np.arange(len(chr_names) + 1))
+        self.positions = positions
+        self.chr_offsets = {chr_name: (int(chr_bounds[i]), int(chr_bounds[i + 1]))
+                            for i, chr_name in enumerate(chr_names) if chr_bounds[i] < chr_bounds[i + 1]}
+        self.track_pyramids = {}
+        self.map_version += 1
+
+    def get_row_range(self, chr_col_choice, start=None, end=None):
+        """
+        :param chr_col_choice: sequence (chromosome/plasmid) to query
+        :param start: first insertion site to include, defaults to the start of the sequence
+        :param end: last insertion site to include, defaults to the end of the sequence
+        :return: first and last (exclusive) row of the sorted map holding the matching insertions
+        """
+        if self.positions is None:
+            self.build_position_index()
+        chr_start, chr_stop = self.chr_offsets.get(chr_col_choice, (0, 0))
+        chr_positions = self.positions[chr_start:chr_stop]
+        first = chr_start + (np.searchsorted(chr_positions, start, side='left') if start is not None else 0)
+        last = chr_start + (np.searchsorted(chr_positions, end, side='right') if end is not None else chr_positions.size)
+        return int(first), int(last)
+
+    def get_insertions(self, chr_col_choice, start=None, end=None) -> pd.DataFrame:
+        """
+        Insertions of one sequence, optionally restricted to sites between start and end, sorted by site
+        """
+        first, last = self.get_row_range(chr_col_choice, start, end)
+        return self.lib_map.iloc[first:last]
+
+    def get_coverage_bins(self, chr_col_choice, num_bins) -> pd.DataFrame:
+        """
+        Bin insertions of one sequence on the server, so only num_bins counts per library reach the browser
 
-    def graph_coverage_hist(self, chr_col_choice, num_bins, hist_col):
-        df_to_show = self.lib_map[self.lib_map[self.chr_col] == chr_col_choice].sort_values(self.insertion_site_col)
-        fig = px.histogram(df_to_show, x=self.insertion_site_col, nbins=int(num_bins),
-                           labels={self.insertion_site_col: 'Position, bp'}, color_discrete_sequence=[hist_col])
-        fig.update_layout(bargap=0.1)
+        :param chr_col_choice: sequence (chromosome/plasmid) to bin
+        :param num_bins: number of equal width bins spanning the first to the last insertion
+        :return: long data frame with one row per library and bin
+        """
+        first, last = self.get_row_range(chr_col_choice)
+        positions = self.positions[first:last]
+        if positions.size == 0:
+            return pd.DataFrame(columns=['library', 'bin_start', 'bin_end', 'bin_center', 'count'])
+        library_codes = self.lib_map['library'].cat.codes.to_numpy()[first:last]
+        library_names = self.lib_map['library'].cat.categories
+        bin_edges = np.linspace(positions[0], positions[-1], int(num_bins) + 1)
+        bin_dfs = []
+        for library_code in np.unique(library_codes):
+            # Masking keeps the positions sorted
+            counts = bin_sorted_positions(positions[library_codes == library_code], bin_edges)
+            bin_dfs.append(pd.DataFrame({'library': library_names[library_code], 'bin_start': bin_edges[:-1], 'bin_end': bin_edges[1:],
+                                         'bin_center': (bin_edges[:-1] + bin_edges[1:]) / 2, 'count': counts}))
+        return pd.concat(bin_dfs, ignore_index=True)
+
+    def get_insertion_gaps(self, chr_col_choice, min_length=1, max_gaps=None, gene_col=None) -> pd.DataFrame:
+        """
+        Insertion-free regions of one sequence (candidate essential regions), longest first.
+        A gap is the stretch between two consecutive insertion sites, so regions before the first
+        and after the last insertion are not reported.
+
+        :param chr_col_choice: sequence (chromosome/plasmid) to scan
+        :param min_length: shortest gap to report, bp
+        :param max_gaps: report only the longest max_gaps gaps
+        :param gene_col: attribute naming the genes that overlap each gap, defaults to Name or the first attribute.
+            Gene coordinates come from the optional gene_start/gene_end columns; genes without any insertion
+            are not in the map and cannot be listed.
+        :return: data frame with gap start, end, length and rank, plus overlapping genes if available
+        """
+        first, last = self.get_row_range(chr_col_choice)
+        positions = self.positions[first:last].astype(np.int64)
+        lengths = np.diff(positions) - 1
+        gap_idx = np.flatnonzero(lengths >= min_length)
+        gap_idx = gap_idx[np.argsort(-lengths[gap_idx], kind='stable')][:max_gaps]
+        gaps = pd.DataFrame({self.chr_col: chr_col_choice,
+                             'gap_start': positions[gap_idx] + 1,
+                             'gap_end': positions[gap_idx + 1] - 1,
+                             'length': lengths[gap_idx],
+                             'rank': np.arange(1, gap_idx.size + 1)})
+        if gene_col is None and self.attributes:
+            gene_col = 'Name' if 'Name' in self.attributes else self.attributes[0]
+        if gene_col and {self.gene_start_col, self.gene_end_col}.issubset(self.lib_map.columns):
+            gaps['genes'] = self._get_overlapping_genes(first, last, gene_col, gaps['gap_start'].to_numpy(),
+                                                        gaps['gap_end'].to_numpy())
+        return gaps
+
+    def _get_overlapping_genes(self, first, last, gene_col, region_starts, region_ends) -> List[str]:
+        """
+        Names of genes of map rows first:last overlapping each region. Genes are sorted by start once;
+        the running maximum of their ends bounds, by binary search, the candidates for each region.
+        """
+        genes = (self.lib_map.iloc[first:last][[gene_col, self.gene_start_col, self.gene_end_col]]
+                 .dropna().drop_duplicates().sort_values(self.gene_start_col))
+        names = genes[gene_col].astype(str).to_numpy()
+        starts, ends = genes[self.gene_start_col].to_numpy(), genes[self.gene_end_col].to_numpy()
+        max_ends = np.maximum.accumulate(ends) if ends.size else ends
+        lows = np.searchsorted(max_ends, region_starts, side='left')
+        highs = np.searchsorted(starts, region_ends, side='right')
+        return [', '.join(names[low:high][ends[low:high] >= region_start])
+                for low, high, region_start in zip(lows, highs, region_starts)]
+
+    def graph_coverage_hist(self, chr_col_choice, num_bins, hist_col, gaps=None):
+        """
+        :param gaps: optional data frame from get_insertion_gaps, drawn as shaded regions
+        """
+        bins_df = self.get_coverage_bins(chr_col_choice, num_bins)
+        _, _, all_clrs = define_color_scheme()
+        fig = px.bar(bins_df, x='bin_center', y='count', color='library',
+                     hover_data={'bin_start': ':.0f', 'bin_end': ':.0f', 'bin_center': False},
+                     labels={'bin_center': 'Position, bp'}, color_discrete_sequence=[hist_col] + all_clrs)
+        fig.update_layout(bargap=0.1, barmode='stack', showlegend=bins_df['library'].nunique() > 1)
+        if gaps is not None:
+            # One layout update for all regions; add_vrect relayouts the figure once per shape
+            fig.update_layout(shapes=[dict(type='rect', xref='x', yref='paper', x0=gap_start, x1=gap_end, y0=0, y1=1,
+                                           fillcolor='grey', opacity=0.3, line_width=0, layer='below')
+                                      for gap_start, gap_end in zip(gaps['gap_start'], gaps['gap_end'])])
         fig.update_xaxes(showline=True, linewidth=1, linecolor='black',
-                         tickfont=dict(size=24, color='black'),  titlefont=dict(size=30, color='black'))
+                         tickfont=dict(size=24, color='black'),  title_font=dict(size=30, color='black'))
         fig.update_yaxes(showline=True, linewidth=1, linecolor='black',
-                         tickfont=dict(size=24, color='black'), titlefont=dict(size=30, color='black'))
+                         tickfont=dict(size=24, color='black'), title_font=dict(size=30, color='black'))
         return fig
 
     def graph_insertions(self, chr_col_choice, color_by_choice, all_clrs):
-        df_to_show = self.lib_map[self.lib_map[self.chr_col] == chr_col_choice].sort_values(self.insertion_site_col)
+        df_to_show = self.get_insertions(chr_col_choice)
         fig = px.scatter(df_to_show, x=self.insertion_site_col, y=self.abundance_col, color=color_by_choice, log_y=True,
                          height=600, template='plotly_white',
                          color_discrete_sequence=all_clrs, hover_data=self.attributes,
@@ -136,35 +734,295 @@ class LibraryMap:
                           autosize=True,
                           font=dict(size=24))
         fig.update_xaxes(showline=True, linewidth=1, linecolor='black',
-                         tickfont=dict(size=18, color='black'), titlefont=dict(size=24, color='black'))
+                         tickfont=dict(size=18, color='black'), title_font=dict(size=24, color='black'))
         fig.update_yaxes(showline=True, linewidth=1, linecolor='black',
-                         tickfont=dict(size=18, color='black'), titlefont=dict(size=24, color='black'))
+                         tickfont=dict(size=18, color='black'), title_font=dict(size=24, color='black'))
+        return fig
+
+    def _build_track_pyramid(self, chr_col_choice) -> dict:
+        """
+        Summarize insertions of one sequence in fixed windows (number of insertions, sum and max abundance),
+        then coarsen the windows by zoom_factor until a single window covers the whole sequence
+        """
+        first, last = self.get_row_range(chr_col_choice)
+        positions = self.positions[first:last]
+        abundance = self.lib_map[self.abundance_col].to_numpy()[first:last].astype(np.float64)
+        origin, window = int(positions[0]), int(self.track_config['base_window'])
+        window_idx = (positions - origin) // window
+        n_windows = int(window_idx[-1]) + 1
+        occupied, window_starts = np.unique(window_idx, return_index=True)
+        maxima = np.zeros(n_windows)
+        maxima[occupied] = np.maximum.reduceat(abundance, window_starts)
+        levels = [{'window': window,
+                   'count': np.bincount(window_idx, minlength=n_windows),
+                   'sum': np.bincount(window_idx, weights=abundance, minlength=n_windows),
+                   'max': maxima}]
+        zoom_factor = int(self.track_config['zoom_factor'])
+        while levels[-1]['count'].size > 1:
+            finer = levels[-1]
+            padding = -finer['count'].size % zoom_factor
+            levels.append({'window': finer['window'] * zoom_factor,
+                           **{stat: getattr(np, reduce)(np.pad(finer[stat], (0, padding)).reshape(-1, zoom_factor),
+                                                        axis=1)
+                              for stat, reduce in [('count', 'sum'), ('sum', 'sum'), ('max', 'max')]}})
+        return {'origin': origin, 'levels': levels}
+
+    def _get_track_pyramid(self, chr_col_choice) -> dict:
+        if chr_col_choice not in self.track_pyramids:
+            self.track_pyramids[chr_col_choice] = self._build_track_pyramid(chr_col_choice)
+        return self.track_pyramids[chr_col_choice]
+
+    def get_position_range(self, chr_col_choice):
+        first, last = self.get_row_range(chr_col_choice)
+        return int(self.positions[first]), int(self.positions[last - 1])
+
+    def get_track_tiles(self, chr_col_choice, start, end) -> pd.DataFrame:
+        """
+        Return the non-empty windows overlapping [start, end] at the finest resolution
+        that keeps the number of windows under max_tiles
+        """
+        pyramid = self._get_track_pyramid(chr_col_choice)
+        origin = pyramid['origin']
+        for level in pyramid['levels']:
+            first = max((int(start) - origin) // level['window'], 0)
+            last = min((int(end) - origin) // level['window'] + 1, level['count'].size)
+            if last - first <= self.track_config['max_tiles']:
+                break
+        window_start = origin + np.arange(first, last) * level['window']
+        count = level['count'][first:last]
+        tiles = pd.DataFrame({'window_start': window_start,
+                              'window_end': window_start + level['window'] - 1,
+                              'window_center': window_start + (level['window'] - 1) / 2,
+                              'insertions': count,
+                              'max_abundance': level['max'][first:last],
+                              'mean_abundance': level['sum'][first:last] / np.maximum(count, 1)})
+        return tiles[tiles['insertions'] > 0]
+
+    def graph_insertion_track(self, chr_col_choice, start, end, color_by_choice, all_clrs):
+        """
+        WebGL genome track: individual insertions when fewer than max_raw_points fall into the visible range,
+        otherwise max and mean abundance per window from the track pyramid
+        """
+        first, last = self.get_row_range(chr_col_choice, start, end)
+        labels = {self.insertion_site_col: 'Position, bp', self.abundance_col: 'Read Counts'}
+        if last - first <= self.track_config['max_raw_points']:
+            df_to_show = self.lib_map.iloc[first:last]
+            fig = px.scatter(df_to_show, x=self.insertion_site_col, y=self.abundance_col, color=color_by_choice,
+                             log_y=True, height=600, template='plotly_white', render_mode='webgl',
+                             color_discrete_sequence=all_clrs, hover_data=self.attributes, labels=labels)
+            fig.update_traces(marker=dict(size=8, opacity=0.7))
+        else:
+            tiles = self.get_track_tiles(chr_col_choice, start, end)
+            window_data = tiles[['window_start', 'window_end', 'insertions']].to_numpy()
+            hover = ('%{customdata[0]}-%{customdata[1]} bp<br>%{customdata[2]} insertions<br>'
+                     '%{fullData.name}: %{y:.0f}<extra></extra>')
+            fig = go.Figure([go.Scattergl(x=tiles['window_center'], y=tiles[stat], mode='markers', name=name,
+                                          marker=dict(size=8, color=clr, opacity=0.7),
+                                          customdata=window_data, hovertemplate=hover)
+                             for stat, name, clr in [('max_abundance', 'Max abundance', all_clrs[0]),
+                                                     ('mean_abundance', 'Mean abundance', all_clrs[1])]])
+            fig.update_layout(template='plotly_white', height=600)
+            fig.update_xaxes(title_text=labels[self.insertion_site_col])
+            fig.update_yaxes(title_text=labels[self.abundance_col], type='log')
+        fig.update_xaxes(range=[start, end])
+        fig.update_layout({'paper_bgcolor': 'rgba(0,0,0,0)', 'plot_bgcolor': 'rgba(0,0,0,0)'},
+                          autosize=True,
+                          font=dict(size=24))
+        fig.update_xaxes(showline=True, linewidth=1, linecolor='black',
+                         tickfont=dict(size=18, color='black'), title_font=dict(size=24, color='black'))
+        fig.update_yaxes(showline=True, linewidth=1, linecolor='black',
+                         tickfont=dict(size=18, color='black'), title_font=dict(size=24, color='black'))
+        return fig
+
+    def get_barcode_presence(self) -> np.ndarray:
+        """
+        Boolean barcode x library matrix, indexed by the codes of the shared barcode dictionary
+        and of the library column. Cached until a new map is loaded.
+        """
+        cached_version, presence = self._barcode_presence
+        if cached_version != self.map_version:
+            barcode_codes, barcodes = self._column_codes(self.barcode_col)
+            library_codes, libraries = self._column_codes('library')
+            presence = np.zeros((len(barcodes), len(libraries)), dtype=bool)
+            presence[barcode_codes, library_codes] = True
+            self._barcode_presence = (self.map_version, presence)
+        return presence
+
+    def get_barcode_overlap(self) -> pd.DataFrame:
+        """
+        Library x library table of the number of barcodes found in both libraries
+        (the diagonal holds the number of barcodes per library)
+        """
+        presence = self.get_barcode_presence().astype(np.int32)
+        libraries = self._column_codes('library')[1]
+        return pd.DataFrame(presence.T @ presence, index=libraries, columns=libraries)
+
+    def get_shared_barcodes(self, min_libraries=2) -> pd.DataFrame:
+        """
+        Barcodes found in at least min_libraries libraries
+        """
+        n_libraries = self.get_barcode_presence().sum(axis=1)
+        shared = np.flatnonzero(n_libraries >= min_libraries)
+        barcodes = self._column_codes(self.barcode_col)[1]
+        return pd.DataFrame({self.barcode_col: barcodes[shared], 'number of libraries': n_libraries[shared]})
+
+    def get_library_specific_barcodes(self) -> pd.DataFrame:
+        """
+        Barcodes found in exactly one library, with that library
+        """
+        presence = self.get_barcode_presence()
+        specific = np.flatnonzero(presence.sum(axis=1) == 1)
+        barcodes = self._column_codes(self.barcode_col)[1]
+        libraries = self._column_codes('library')[1]
+        return pd.DataFrame({self.barcode_col: barcodes[specific],
+                             'library': libraries[presence[specific].argmax(axis=1)]})
+
+    def get_barcode_collisions(self) -> pd.DataFrame:
+        """
+        Barcodes mapped to more than one insertion site (within or across libraries), e.g. because
+        the same barcode was independently inserted at different sites in different libraries.
+        Cached until a new map is loaded.
+        """
+        cached_version, collisions = self._barcode_collisions
+        if cached_version != self.map_version:
+            collisions = self._find_barcode_collisions()
+            self._barcode_collisions = (self.map_version, collisions)
+        return collisions.copy()
+
+    def _find_barcode_collisions(self) -> pd.DataFrame:
+        barcode_codes, barcodes = self._column_codes(self.barcode_col)
+        chr_codes = self.lib_map[self.chr_col].cat.codes.to_numpy().astype(np.int64)
+        site_keys = (chr_codes << 32) | self.lib_map[self.insertion_site_col].to_numpy().astype(np.int64)
+        order = np.lexsort((site_keys, barcode_codes))
+        barcode_codes, site_keys = barcode_codes[order], site_keys[order]
+        # Count distinct sites per barcode: a new site starts wherever the sorted (barcode, site) pair changes
+        new_site = np.ones(len(order), dtype=bool)
+        new_site[1:] = (barcode_codes[1:] != barcode_codes[:-1]) | (site_keys[1:] != site_keys[:-1])
+        n_sites = np.bincount(barcode_codes[new_site], minlength=len(barcodes))
+        collided = np.flatnonzero(n_sites > 1)
+        presence = self.get_barcode_presence()[collided]
+        libraries = np.asarray(self._column_codes('library')[1])
+        return pd.DataFrame({self.barcode_col: barcodes[collided],
+                             'number of insertion sites': n_sites[collided],
+                             'libraries': [', '.join(libraries[row]) for row in presence]})
+
+    def _column_codes(self, col):
+        """
+        Integer codes (-1 for missing values) and the distinct values of a map column
+        """
+        if isinstance(self.lib_map[col].dtype, pd.CategoricalDtype):
+            return self.lib_map[col].cat.codes.to_numpy(), self.lib_map[col].cat.categories
+        return pd.factorize(self.lib_map[col])
+
+    def _get_gene_index(self, gene_col):
+        """
+        Rows of the map grouped by gene: one array of row numbers ordered by gene code, plus offsets per gene code.
+        The sort is stable, so rows of a gene stay ordered by sequence and insertion site.
+        """
+        if self._gene_index.get(gene_col, (None,))[0] != self.map_version:
+            gene_codes, genes = self._column_codes(gene_col)
+            rows = np.argsort(gene_codes, kind='stable')
+            offsets = np.searchsorted(gene_codes[rows], np.arange(len(genes) + 1))
+            self._gene_index[gene_col] = (self.map_version, genes, rows, offsets)
+        return self._gene_index[gene_col][1:]
+
+    def get_genes_with_insertions(self, gene_col) -> List:
+        genes, _, offsets = self._get_gene_index(gene_col)
+        return list(genes[np.diff(offsets) > 0])
+
+    def get_gene_insertions(self, gene, gene_col) -> pd.DataFrame:
+        """
+        Insertions annotated with one gene, found through the gene index instead of scanning the map
+        """
+        genes, rows, offsets = self._get_gene_index(gene_col)
+        if gene not in genes:
+            return self.lib_map.iloc[:0]
+        gene_code = genes.get_loc(gene)
+        return self.lib_map.iloc[rows[offsets[gene_code]:offsets[gene_code + 1]]]
+
+    def graph_needle(self, gene, gene_col, color_by_choice, all_clrs):
+        """
+        Needle plot of the insertions annotated with one gene, drawn over the gene coordinates
+        (from the optional gene_start/gene_end/gene_strand columns, if the map has them)
+        """
+        gene_df = self.get_gene_insertions(gene, gene_col)
+        hover_cols = [c for c in self.attributes + [self.percentile_col, self.distance_col] if c in gene_df.columns]
+        fig = px.scatter(gene_df, x=self.insertion_site_col, y=self.abundance_col, color=color_by_choice,
+                         error_y=np.zeros(len(gene_df)), error_y_minus=gene_df[self.abundance_col],
+                         height=500, template='plotly_white',
+                         color_discrete_sequence=all_clrs, hover_data=hover_cols,
+                         labels={self.insertion_site_col: 'Position, bp',
+                                 self.abundance_col: 'Read Counts'})
+        fig.update_traces(marker=dict(size=12), error_y=dict(width=0, thickness=1.5))
+        if {self.gene_start_col, self.gene_end_col}.issubset(gene_df.columns):
+            gene_start, gene_end = gene_df[self.gene_start_col].min(), gene_df[self.gene_end_col].max()
+        else:
+            gene_start, gene_end = gene_df[self.insertion_site_col].min(), gene_df[self.insertion_site_col].max()
+        strand = gene_df[self.strand_col].iloc[0] if self.strand_col in gene_df.columns and len(gene_df) else ''
+        max_abundance = gene_df[self.abundance_col].max() if len(gene_df) else 1
+        fig.add_shape(type='rect', x0=gene_start, x1=gene_end, y0=-0.08 * max_abundance, y1=0,
+                      fillcolor='grey', line=dict(width=0), opacity=0.5)
+        fig.add_annotation(x=(gene_start + gene_end) / 2, y=-0.04 * max_abundance, showarrow=False,
+                           text={'+': f'{gene} →', '-': f'← {gene}'}.get(strand, gene))
+        fig.update_yaxes(range=[-0.1 * max_abundance, 1.1 * max_abundance])
+        fig.update_layout({'paper_bgcolor': 'rgba(0,0,0,0)', 'plot_bgcolor': 'rgba(0,0,0,0)'},
+                          autosize=True,
+                          font=dict(size=24))
+        fig.update_xaxes(showline=True, linewidth=1, linecolor='black',
+                         tickfont=dict(size=18, color='black'), title_font=dict(size=24, color='black'))
+        fig.update_yaxes(showline=True, linewidth=1, linecolor='black',
+                         tickfont=dict(size=18, color='black'), title_font=dict(size=24, color='black'))
         return fig
 
     def get_stats(self):
-        table1 = (self.lib_map.groupby('library')
-                  .agg({self.barcode_col: ['nunique'], self.distance_col: [lambda x: sum(x != 0)]})
-                  .reset_index())
-        table1.columns = ["Library", '# of insertions', '# of insertions outside of CDS']
-        table1 = table1.set_index('Library')
+        """
+        Per library insertion summary, computed with bincounts over integer codes of the map columns.
+        The table is cached until a new map is loaded.
+        """
+        stats_key = (self.map_version, tuple(self.attributes))
+        if self._stats_key == stats_key:
+            return
+        library_codes, library_names = self._column_codes('library')
+        n_libraries = len(library_names)
+        in_cds = (self.lib_map[self.distance_col] == 0).to_numpy()
+        barcode_codes, _ = self._column_codes(self.barcode_col)
+        stats = {'# of insertions': count_unique_per_group(library_codes, barcode_codes, n_libraries),
+                 '# of insertions outside of CDS': np.bincount(library_codes[~in_cds], minlength=n_libraries)}
         for att in self.attributes:
-            table1[f'# of {att}s with insertion'] = (self.lib_map[self.lib_map[self.distance_col] == 0]
-                                                     .groupby('library')[att].nunique())
-        table2 = (self.lib_map.groupby(['library', self.attributes[0]])[self.barcode_col].count()
-                  .reset_index().groupby('library')
-                  .agg({self.barcode_col: ['median', 'max']})
-                  .reset_index())
-        table2.columns = ['Library', f'Median insertions per {self.attributes[0]}', f'Max insertions per {self.attributes[0]}']
-        table2[f'Median insertions per {self.attributes[0]}'] = table2[f"Median insertions per {self.attributes[0]}"].astype(int)
-        table2 = table2.set_index('Library')
-        self.stats = table1.merge(table2, left_index=True, right_index=True)
+            att_codes, _ = self._column_codes(att)
+            stats[f'# of {att}s with insertion'] = count_unique_per_group(library_codes[in_cds], att_codes[in_cds],
+                                                                          n_libraries)
+        if self.attributes:
+            gene_col = self.attributes[0]
+            gene_codes, gene_names = self._column_codes(gene_col)
+            counted = (gene_codes >= 0) & (barcode_codes >= 0)
+            insertions_per_gene = (np.bincount(library_codes[counted].astype(np.int64) * len(gene_names)
+                                               + gene_codes[counted], minlength=n_libraries * len(gene_names))
+                                   .reshape(n_libraries, len(gene_names)))
+            gene_counts = [lib_counts[lib_counts > 0] for lib_counts in insertions_per_gene]
+            stats[f'Median insertions per {gene_col}'] = [int(np.median(c)) if c.size else 0 for c in gene_counts]
+            stats[f'Max insertions per {gene_col}'] = [int(c.max()) if c.size else 0 for c in gene_counts]
+        self.stats = pd.DataFrame(stats, index=pd.Index(np.asarray(library_names), name='Library')).sort_index()
+        self._stats_key = stats_key
 
 
 class CountDataSet:
-    def __init__(self, count_file, sample_data_file, config_file: str = 'scripts/config.yaml'):
+    # Number of normalized values densified at a time when computing per-barcode statistics
+    STATS_BLOCK_VALUES = 2 ** 22
+
+    def __init__(self, count_file, sample_data_file, config_file: str = 'scripts/config.yaml', storage=None,
+                 sample_count_files: List = (), gene_attribute=None):
+        """
+        :param count_file: merged count table (barcode, gene and one column per sample), None for per-sample files
+        :param storage: 'sparse' (CSR matrix) or 'dense' count matrix, defaults to eda.storage in the config file
+        :param sample_count_files: per-sample mbarq count files (barcode, count, annotation columns), merged into an
+            on-disk store instead of reading count_file. Sample IDs are the file names up to '_mbarq'
+        :param gene_attribute: annotation column of the per-sample files used as gene identifier,
+            defaults to eda.merge.gene_attribute in the config file
+        """
         self.count_file = count_file
+        self.sample_count_files = sample_count_files
         self.sample_data_file = sample_data_file
-        self.count_data = pd.read_csv(self.count_file)
         self.sample_data = pd.read_csv(self.sample_data_file).fillna('N/A')
         with open(config_file, 'r') as cf:
             config = yaml.load(cf, Loader=yaml.SafeLoader)['eda']
@@ -174,8 +1032,55 @@ class CountDataSet:
         self.barcode_col = self.col_name_config['barcode_col']
         self.gene_name_col = self.col_name_config['gene_name_col']
         self.sample_id_col = self.col_name_config['sample_id_col']
+        self.storage = storage if storage else config.get('storage', 'sparse')
+        if self.storage not in COUNT_STORAGE_MODES:
+            raise ValueError(f"Unknown count storage {self.storage}, choose one of {', '.join(COUNT_STORAGE_MODES)}")
+        self.chunksize = config.get('chunksize', 100000)
+        # Per-sample count files are merged into a Parquet store keyed on a hash of their contents
+        self.store_dir = Path(config['merge']['store_dir'])
+        self.max_count_stores = config['merge']['max_stores']
+        self.gene_attribute = gene_attribute if gene_attribute else config['merge']['gene_attribute']
+        # Normalization defaults and plot settings
+        self.norm_method = config['normalization']['method']
+        self.pseudocount = config['normalization']['pseudocount']
+        self.pca_randomized_min_features = config['pca']['randomized_min_features']
+        # Barcode abundance plots with more points than this are summarized on the server
+        self.abundance_summary_min_points = config['abundance_plot']['summary_min_points']
+        self.abundance_max_points = config['abundance_plot']['max_points']
+        self.abundance_kde_points = config['abundance_plot']['kde_points']
+        # Barcodes x samples count matrix, with barcode and gene of each row kept as separate arrays
+        self.barcodes = np.array([], dtype=object)
+        self.genes = pd.Categorical([])
+        self.samples = []
+        self.counts = None
+        self.count_hash = ''
+        # Rows are barcodes, or genes in a gene-level view
+        self.level = 'barcode'
+        self._reset_derived()
         self.valid = self._validate()
-        self.norm_counts = pd.DataFrame()
+
+    def _reset_derived(self):
+        """
+        Clear everything derived from the count matrix: indexes, normalizations and the analyses cached on them
+        """
+        self._gene_index = None
+        self._gene_list = None
+        # Normalized matrix over norm_samples; stored values + norm_offset (per sample) = normalized values
+        self.norm_value_col = NORMALIZATION_METHODS.get(self.norm_method, '')
+        self.norm_counts = None
+        self.norm_samples = []
+        self.norm_offset = np.zeros(0, dtype=np.float32)
+        # (count hash, method, pseudocount) -> (norm_samples, norm_counts, norm_offset)
+        self._norm_cache = {}
+        self.norm_key = None
+        # (norm key, number of barcodes, number of PCs, selection) -> (PC data frame, % variance per PC)
+        self._pca_cache = {}
+        # Per-barcode mean and variance of the normalized matrix, cached against its norm key
+        self._barcode_stats = (None, None, None)
+        # (norm key, method, number of barcodes) -> (correlation data frame, linkage matrix)
+        self._correlation_cache = {}
+        # Aggregation -> gene-level view of this data set
+        self._gene_levels = {}
 
     def _validate(self):
         """
@@ -183,48 +1088,457 @@ class CountDataSet:
         """
         st.write(f"_Using {self.sample_data.columns[0]} to identify samples_")
         self.sample_data = self.sample_data.rename({self.sample_data.columns[0]: self.sample_id_col}, axis=1)
-        st.write(f"_Using {self.count_data.columns[0]} to identify barcodes_")
-        st.write(f"_Using {self.count_data.columns[1]} to identify genes_")
-        self.count_data = (self.count_data.rename({self.count_data.columns[0]: self.barcode_col,
-                                                   self.count_data.columns[1]: self.gene_name_col}, axis=1)
-                           .dropna(subset=[self.gene_name_col])
-                           .drop_duplicates())
-        samples_found = list(set(self.sample_data[self.sample_id_col].unique()).intersection(self.count_data.columns))
+        sample_ids = set(self.sample_data[self.sample_id_col].unique())
+        if self.sample_count_files:
+            sample_files = {sample_id_from_count_file(f): f for f in self.sample_count_files}
+            samples_found = [s for s in sample_files if s in sample_ids]
+        else:
+            header = pd.read_csv(self.count_file, nrows=0).columns
+            if hasattr(self.count_file, 'seek'):
+                self.count_file.seek(0)
+            st.write(f"_Using {header[0]} to identify barcodes_")
+            st.write(f"_Using {header[1]} to identify genes_")
+            renamed = [self.barcode_col, self.gene_name_col] + list(header[2:])
+            samples_found = [c for c in renamed if c in sample_ids]
         if not samples_found or self.barcode_col in samples_found or self.gene_name_col in samples_found:
             st.error("No common samples found between sample data file and count table")
             return False
         self.sample_data = self.sample_data[self.sample_data[self.sample_id_col].isin(samples_found)]
-        self.count_data = self.count_data[[self.barcode_col, self.gene_name_col] + samples_found]
-        if self.count_data.empty:
+        self.samples = samples_found
+        if self.sample_count_files:
+            try:
+                self._read_count_store(self._merge_sample_files([sample_files[s] for s in samples_found]))
+            except (ImportError, KeyError, ValueError) as err:
+                st.error(f"Could not merge the count files: {err.args[0]}")
+                return False
+        else:
+            self._read_counts(list(header[:2]))
+        if self.counts.shape[0] == 0:
             return False
         return True
 
-    def normalize_counts(self):
-        self.norm_counts = self.count_data.set_index([self.barcode_col, self.gene_name_col]).copy()
-        self.norm_counts = self.norm_counts.loc[:, self.norm_counts.sum() > 0]
-        self.norm_counts = np.log2((self.norm_counts / self.norm_counts.sum()) * 1000000 + 0.5).reset_index()
+    def _merge_sample_files(self, sample_files: List) -> Path:
+        """
+        Stream per-sample count files (in self.samples order) into an on-disk store, unless a store for the same
+        file contents exists. Each file is hash-joined on barcode against the dictionary of barcodes seen so far
+        (one incrementally grown pandas hash table), and its non-zero counts are written as one Parquet row group of (row, sample, count),
+        so memory is bounded by one sample file plus the barcode dictionary.
+        Barcodes without a gene annotation are skipped; duplicated barcodes within a file are summed.
+        :return: path of the store directory
+        """
+        import pyarrow
+        import pyarrow.parquet as pq
+        store_key = hashlib.sha256(f"{self.gene_attribute}:{self.samples}".encode())
+        for sample_file in sample_files:
+            store_key.update(read_upload_bytes(sample_file))
+        store_path = self.store_dir / store_key.hexdigest()
+        if store_path.exists():
+            store_path.touch()
+            return store_path
+        tmp_path = store_path.with_suffix('.tmp')
+        tmp_path.mkdir(parents=True, exist_ok=True)
+        # Barcode -> row hash table, grown with the new barcodes of each file instead of rebuilt per file
+        barcode_factorizer = hashtable.ObjectFactorizer(self.chunksize)
+        new_barcode_dfs = []
+        schema = pyarrow.schema([('row', pyarrow.int32()), ('sample', pyarrow.int32()), ('count', pyarrow.int32())])
+        with pq.ParquetWriter(tmp_path / 'counts.parquet', schema) as writer:
+            for sample_code, (sample_id, sample_file) in enumerate(zip(self.samples, sample_files)):
+                st.write(f"_Merging {sample_id}_")
+                raw_counts = io.BytesIO(read_upload_bytes(sample_file))
+                header = pd.read_csv(raw_counts, nrows=0).columns
+                if self.gene_attribute not in header:
+                    raise KeyError(f"No {self.gene_attribute} column in the count file of {sample_id}")
+                raw_counts.seek(0)
+                sample_df = (pd.read_csv(raw_counts, usecols=[header[0], header[1], self.gene_attribute])
+                             .dropna(subset=[self.gene_attribute]))
+                sample_df = sample_df[sample_df[header[1]] > 0]
+                sample_df = sample_df.dropna(subset=[header[0]])
+                # Known barcodes get their row, new ones the next free rows in order of first appearance
+                n_barcodes = barcode_factorizer.get_count()
+                rows = barcode_factorizer.factorize(sample_df[header[0]].to_numpy(dtype=object))
+                new_barcodes = rows >= n_barcodes
+                if new_barcodes.any():
+                    new_df = sample_df.loc[new_barcodes, [header[0], self.gene_attribute]].drop_duplicates(header[0])
+                    new_barcode_dfs.append(new_df.set_axis([self.barcode_col, self.gene_name_col], axis=1))
+                counts = sample_df[header[1]].to_numpy()
+                if pd.Index(rows).has_duplicates:
+                    rows, inverse = np.unique(rows, return_inverse=True)
+                    counts = np.bincount(inverse, weights=counts)
+                writer.write_table(pyarrow.table({'row': rows.astype(np.int32),
+                                                  'sample': np.full(rows.size, sample_code, dtype=np.int32),
+                                                  'count': counts.astype(np.int32)}, schema=schema))
+        barcode_df = (pd.concat(new_barcode_dfs, ignore_index=True) if new_barcode_dfs
+                      else pd.DataFrame(columns=[self.barcode_col, self.gene_name_col]))
+        barcode_df.astype(str).to_parquet(tmp_path / 'barcodes.parquet', index=False)
+        tmp_path.replace(store_path)
+        stores = sorted((d for d in self.store_dir.iterdir() if d.suffix != '.tmp'), key=lambda d: d.stat().st_mtime,
+                        reverse=True)
+        for stale_store in stores[self.max_count_stores:]:
+            shutil.rmtree(stale_store, ignore_errors=True)
+        return store_path
+
+    def _read_count_store(self, store_path: Path):
+        """
+        Build the count matrix from a merged store: barcode and gene per row, plus (row, sample, count) triplets
+        """
+        import pyarrow.parquet as pq
+        barcode_df = pd.read_parquet(store_path / 'barcodes.parquet')
+        self.barcodes = barcode_df[self.barcode_col].to_numpy(dtype=object)
+        self.genes = pd.Categorical(barcode_df[self.gene_name_col])
+        triplets = pq.read_table(store_path / 'counts.parquet')
+        rows, samples, counts = (triplets.column(c).to_numpy() for c in ('row', 'sample', 'count'))
+        shape = (len(self.barcodes), len(self.samples))
+        if self.storage == 'sparse':
+            self.counts = sparse.csr_matrix((counts, (rows, samples)), shape=shape, dtype=np.int32)
+        else:
+            self.counts = np.zeros(shape, dtype=np.int32)
+            self.counts[rows, samples] = counts
+        self.count_hash = self._hash_counts()
+
+    def _read_counts(self, id_columns: List[str]):
+        """
+        Read the count table in chunks, keeping only annotated barcodes and converting each chunk to the
+        count matrix as it is read, so the full table never exists as a dense data frame in sparse mode.
+        Duplicated rows are dropped by comparing row hashes across chunks.
+        """
+        annotations, blocks, row_hashes = [], [], []
+        columns = [self.barcode_col, self.gene_name_col] + self.samples
+        for chunk in pd.read_csv(self.count_file, usecols=id_columns + self.samples, chunksize=self.chunksize):
+            chunk = (chunk.rename({id_columns[0]: self.barcode_col, id_columns[1]: self.gene_name_col}, axis=1)
+                     .dropna(subset=[self.gene_name_col])[columns])
+            row_hashes.append(pd.util.hash_pandas_object(chunk, index=False).to_numpy())
+            annotations.append(chunk[[self.barcode_col, self.gene_name_col]])
+            values = chunk[self.samples].fillna(0).to_numpy().astype(np.int32)
+            blocks.append(sparse.csr_matrix(values) if self.storage == 'sparse' else values)
+        keep = ~pd.Index(np.concatenate(row_hashes)).duplicated()
+        annotation_df = pd.concat(annotations, ignore_index=True)[keep]
+        self.barcodes = annotation_df[self.barcode_col].to_numpy()
+        self.genes = pd.Categorical(annotation_df[self.gene_name_col])
+        self.counts = sparse.vstack(blocks, format='csr') if self.storage == 'sparse' else np.vstack(blocks)
+        self.counts = self.counts[keep]
+        self.count_hash = self._hash_counts()
+
+    @property
+    def count_data(self) -> pd.DataFrame:
+        """
+        Count table as a data frame (barcode, gene and one column per sample); densifies the sparse matrix
+        """
+        counts = self.counts.toarray() if sparse.issparse(self.counts) else self.counts
+        count_df = pd.DataFrame({self.barcode_col: self.barcodes, self.gene_name_col: self.genes})
+        if counts is None:
+            return count_df
+        return pd.concat([count_df, pd.DataFrame(counts, columns=self.samples)], axis=1)
+
+    def _hash_counts(self) -> str:
+        """
+        Hash of the count matrix and its samples, used to key cached normalizations
+        """
+        count_hash = hashlib.sha256(str(self.samples).encode())
+        arrays = (self.counts.data, self.counts.indices, self.counts.indptr) if sparse.issparse(self.counts) \
+            else (self.counts,)
+        for array in arrays:
+            count_hash.update(np.ascontiguousarray(array).data)
+        return count_hash.hexdigest()
+
+    def normalize_counts(self, method=None, pseudocount=None):
+        """
+        Normalize and log2 transform counts of samples with at least one count; sets norm_counts,
+        norm_samples, norm_offset and norm_value_col.
+        Results are cached per (count matrix hash, method, pseudocount), so switching back to a method is a lookup.
+        :param method: one of NORMALIZATION_METHODS, defaults to eda.normalization.method in the config file
+        :param pseudocount: added to normalized counts before the log transform
+        """
+        method = method if method else self.norm_method
+        pseudocount = self.pseudocount if pseudocount is None else pseudocount
+        if method not in NORMALIZATION_METHODS:
+            raise ValueError(f"Unknown normalization {method}, choose one of {', '.join(NORMALIZATION_METHODS)}")
+        if pseudocount <= 0:
+            raise ValueError("Pseudocount must be positive")
+        norm_key = (self.count_hash, method, pseudocount)
+        if norm_key not in self._norm_cache:
+            self._norm_cache[norm_key] = self._compute_normalization(method, pseudocount)
+        self.norm_samples, self.norm_counts, self.norm_offset = self._norm_cache[norm_key]
+        self.norm_key = norm_key
+        self.norm_method = method
+        self.norm_value_col = NORMALIZATION_METHODS[method]
+
+    def _compute_normalization(self, method, pseudocount):
+        """
+        Per-sample scale factors come from batched column statistics (library sizes, quantiles, TMM,
+        median of ratios); CLR uses raw counts and centers each sample on its mean log abundance.
+        The matrix is computed in place on a single float32 buffer: counts are scaled column by column into
+        the buffer, then the pseudocount and log2 are applied with out= so no full-size intermediates are allocated.
+        In sparse mode the matrix stores log2 values minus log2(pseudocount), which keeps zero counts
+        as structural zeros; the per-sample norm_offset converts the stored values back.
+        :return: normalized samples, normalized matrix and per-sample offset
+        """
+        library_sizes = np.asarray(self.counts.sum(axis=0, dtype=np.float64)).ravel()
+        in_use = library_sizes > 0
+        norm_samples = [s for s, used in zip(self.samples, in_use) if used]
+        counts = self.counts if in_use.all() else self.counts[:, in_use]
+        library_sizes = library_sizes[in_use]
+        if method == 'cpm':
+            scale = 1000000 / library_sizes
+        elif method == 'upper_quartile':
+            scale = 1000000 / (library_sizes * upper_quartile_factors(counts, library_sizes))
+        elif method == 'tmm':
+            scale = 1000000 / (library_sizes * tmm_factors(counts, library_sizes))
+        elif method == 'median_ratio':
+            scale = 1 / median_ratio_size_factors(counts)
+        else:
+            scale = np.ones(library_sizes.size)
+        scale = scale.astype(np.float32)
+        if sparse.issparse(counts):
+            norm = counts.astype(np.float32)
+            # CSR indices are the column (sample) of each stored count
+            np.multiply(norm.data, scale[norm.indices], out=norm.data)
+            np.add(norm.data, pseudocount, out=norm.data)
+            np.log2(norm.data, out=norm.data)
+            np.subtract(norm.data, np.log2(pseudocount), out=norm.data)
+            if method == 'clr':
+                offset = -np.asarray(norm.mean(axis=0, dtype=np.float64)).ravel()
+            else:
+                offset = np.full(scale.size, np.log2(pseudocount))
+        else:
+            norm = np.empty(counts.shape, dtype=np.float32)
+            for col in range(counts.shape[1]):
+                np.multiply(counts[:, col], scale[col], out=norm[:, col])
+            np.add(norm, pseudocount, out=norm)
+            np.log2(norm, out=norm)
+            if method == 'clr':
+                np.subtract(norm, norm.mean(axis=0, dtype=np.float64).astype(np.float32), out=norm)
+            offset = np.zeros(scale.size)
+        return norm_samples, norm, offset.astype(np.float32)
+
+    def get_normalized_rows(self, rows=None) -> np.ndarray:
+        """
+        Dense float32 normalized values (rows x norm_samples) for the given barcode rows, or for all barcodes
+        """
+        norm = self.norm_counts if rows is None else self.norm_counts[rows]
+        if sparse.issparse(norm):
+            norm = norm.toarray()
+        elif rows is None:
+            # Stored dense matrix already holds the normalized values
+            return norm
+        if self.norm_offset.any():
+            np.add(norm, self.norm_offset, out=norm)
+        return norm
+
+    def get_barcode_stats(self):
+        """
+        Mean and sample variance of the normalized abundance of each barcode across samples, computed once per
+        normalized matrix. The matrix is densified in blocks of barcodes (STATS_BLOCK_VALUES values at a time)
+        and each block is reduced in float64, so memory stays bounded for large or sparse matrices.
+        :return: means, variances
+        """
+        cached_key, means, variances = self._barcode_stats
+        if cached_key != self.norm_key:
+            n_barcodes, n_samples = self.norm_counts.shape
+            means, variances = np.empty(n_barcodes), np.empty(n_barcodes)
+            block_size = max(1, self.STATS_BLOCK_VALUES // max(n_samples, 1))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                for start in range(0, n_barcodes, block_size):
+                    block = self.get_normalized_rows(slice(start, start + block_size))
+                    means[start:start + block_size] = block.mean(axis=1, dtype=np.float64)
+                    variances[start:start + block_size] = block.var(axis=1, ddof=1, dtype=np.float64)
+            self._barcode_stats = (self.norm_key, means, variances)
+        return means, variances
+
+    def get_barcode_variance(self) -> np.ndarray:
+        """
+        Sample variance of the normalized abundance of each barcode across samples
+        """
+        return self.get_barcode_stats()[1]
+
+    def get_top_variance_rows(self, num_barcodes) -> np.ndarray:
+        """
+        Rows of the num_barcodes most variable barcodes, in row order.
+        Uses a linear-time partial sort (argpartition) over the cached variances.
+        """
+        variances = self.get_barcode_variance()
+        if num_barcodes >= variances.size:
+            return np.arange(variances.size)
+        return np.sort(np.argpartition(-variances, num_barcodes - 1)[:num_barcodes])
+
+    def _get_gene_index(self):
+        """
+        Barcode rows grouped by gene: one array of row numbers ordered by gene code, plus offsets per gene code.
+        Genes are the (sorted) categories of the gene column; built once, as the genes do not change after loading.
+        """
+        if self._gene_index is None:
+            rows = np.argsort(self.genes.codes, kind='stable')
+            offsets = np.searchsorted(self.genes.codes[rows], np.arange(len(self.genes.categories) + 1))
+            self._gene_index = (rows, offsets)
+        return self._gene_index
+
+    def get_gene_list(self) -> List:
+        """
+        Sorted unique gene names, cached for the gene selection widgets
+        """
+        if self._gene_list is None:
+            self._gene_list = list(self.genes.categories)
+        return self._gene_list
+
+    def get_gene_rows(self, genes) -> np.ndarray:
+        """
+        Barcode rows of the given genes, found through the gene index instead of scanning the gene column
+        """
+        rows, offsets = self._get_gene_index()
+        gene_codes = self.genes.categories.get_indexer(genes)
+        gene_codes = gene_codes[gene_codes >= 0]
+        if not gene_codes.size:
+            return np.array([], dtype=rows.dtype)
+        return np.concatenate([rows[offsets[code]:offsets[code + 1]] for code in gene_codes])
+
+    def get_gene_level(self, aggregation='sum') -> 'CountDataSet':
+        """
+        Gene x sample view of the data set, with counts aggregated over each gene's barcodes; cached per aggregation.
+        The view is a CountDataSet whose rows are the genes, so normalization, PCA, correlation and abundance
+        plots run on it unchanged, with caches of their own.
+        :param aggregation: 'sum' of counts, 'median' count of the barcodes, or 'barcode_count' (counted barcodes)
+        """
+        if aggregation not in GENE_AGGREGATIONS:
+            raise ValueError(f"Unknown aggregation {aggregation}, choose one of {', '.join(GENE_AGGREGATIONS)}")
+        if aggregation not in self._gene_levels:
+            gene_level = copy.copy(self)
+            gene_level.counts = self._aggregate_counts(aggregation)
+            gene_level.barcodes = np.asarray(self.genes.categories, dtype=object)
+            gene_level.genes = pd.Categorical(self.genes.categories)
+            gene_level.level = f'gene ({aggregation})'
+            gene_level._reset_derived()
+            gene_level.count_hash = gene_level._hash_counts()
+            self._gene_levels[aggregation] = gene_level
+        return self._gene_levels[aggregation]
+
+    def _aggregate_counts(self, aggregation):
+        """
+        Sums and barcode counts come from one product with a sparse gene x barcode indicator matrix.
+        Medians sort blocks of samples on (gene, count) keys, with rows already grouped by gene through the gene index,
+        and take the middle of each gene's segment.
+        """
+        n_genes, n_barcodes = len(self.genes.categories), len(self.genes)
+        if aggregation != 'median':
+            indicator = sparse.csr_matrix((np.ones(n_barcodes, dtype=np.int32),
+                                           (self.genes.codes, np.arange(n_barcodes))), shape=(n_genes, n_barcodes))
+            counts = self.counts if aggregation == 'sum' else (self.counts > 0).astype(np.int32)
+            return indicator @ counts
+        rows, offsets = self._get_gene_index()
+        grouped = self.counts[rows]
+        grouped = grouped.tocsc() if sparse.issparse(grouped) else grouped
+        lengths = np.diff(offsets)
+        low, high = offsets[:-1] + (lengths - 1) // 2, offsets[:-1] + lengths // 2
+        gene_keys = np.repeat(np.arange(n_genes, dtype=np.int64), lengths)[:, None] * (int(grouped.max()) + 1)
+        medians = np.empty((n_genes, len(self.samples)), dtype=np.float32)
+        block_size = max(1, self.STATS_BLOCK_VALUES // max(n_barcodes, 1))
+        for start in range(0, len(self.samples), block_size):
+            block = grouped[:, start:start + block_size]
+            keys = gene_keys + (block.toarray() if sparse.issparse(block) else block)
+            keys.sort(axis=0)
+            keys -= gene_keys
+            medians[:, start:start + block_size] = (keys[low] + keys[high]) / 2
+        return sparse.csr_matrix(medians) if self.storage == 'sparse' else medians
+
+    def get_gene_abundance(self, genes) -> pd.DataFrame:
+        """
+        Normalized abundance of every barcode of the given genes in every sample, in long format,
+        built from the rows of those genes only
+        :param genes: list of gene names
+        :return: data frame with barcode, gene, sample ID and normalized value (norm_value_col) columns
+        """
+        rows = self.get_gene_rows(genes)
+        n_samples = len(self.norm_samples)
+        return pd.DataFrame({self.barcode_col: np.repeat(self.barcodes[rows], n_samples),
+                             self.gene_name_col: np.repeat(self.genes.categories[self.genes.codes[rows]], n_samples),
+                             self.sample_id_col: np.tile(self.norm_samples, rows.size),
+                             self.norm_value_col: self.get_normalized_rows(rows).ravel()})
+
+    def get_sample_correlation(self, method='pearson', num_barcodes=None):
+        """
+        Sample x sample correlation of normalized abundances over all barcodes or the num_barcodes most variable
+        ones, with average-linkage clustering on 1 - correlation. Both are cached per (normalized matrix, method,
+        num_barcodes), so only the first view of a combination computes them.
+        :param method: 'pearson' or 'spearman'
+        :return: correlation data frame in clustering order, linkage matrix
+        """
+        if method not in CORRELATION_METHODS:
+            raise ValueError(f"Unknown correlation {method}, choose one of {', '.join(CORRELATION_METHODS)}")
+        correlation_key = (self.norm_key, method, num_barcodes)
+        if correlation_key not in self._correlation_cache:
+            matrix, offset = self.norm_counts, self.norm_offset
+            if num_barcodes:
+                matrix = matrix[self.get_top_variance_rows(int(num_barcodes))]
+            if method == 'spearman':
+                # Stored sparse values are positive for every counted barcode, zeros rank lowest
+                matrix, offset = rank_columns(matrix)
+            correlation = np.nan_to_num(column_correlation(matrix, offset, self.STATS_BLOCK_VALUES))
+            np.fill_diagonal(correlation, 1)
+            linkage = hierarchy.linkage(squareform(np.maximum(1 - correlation, 0), checks=False), method='average')
+            order = hierarchy.leaves_list(linkage)
+            corr_df = pd.DataFrame(correlation, index=self.norm_samples, columns=self.norm_samples)
+            self._correlation_cache[correlation_key] = (corr_df.iloc[order, order], linkage)
+        corr_df, linkage = self._correlation_cache[correlation_key]
+        return corr_df.copy(), linkage
+
+    def sample_correlation_figure(self, corr_df, linkage, method='pearson', w=None, h=None, font_size=12):
+        """
+        Correlation heatmap in clustering order, with the sample dendrogram above it drawn as a single trace.
+        Hover text comes from the categorical axes, and correlations are sent as float32, so the figure stays
+        small for hundreds of samples.
+        """
+        h = h if h else 900
+        w = w if w else 1000
+        samples = list(corr_df.index)
+        _, leaf_coords, heights = dendrogram_lines(linkage)
+        fig = make_subplots(rows=2, cols=1, row_heights=[0.2, 0.8], vertical_spacing=0.01)
+        fig.add_trace(go.Scatter(x=leaf_coords, y=heights, mode='lines', line=dict(color='black', width=1),
+                                 hoverinfo='skip', showlegend=False), row=1, col=1)
+        fig.add_trace(go.Heatmap(z=corr_df.to_numpy(dtype=np.float32), x=samples, y=samples,
+                                 colorscale=px.colors.diverging.RdBu_r, zmax=1,
+                                 colorbar=dict(title=f'{method.capitalize()} r'),
+                                 hovertemplate='%{y} vs %{x}<br>r = %{z:.3f}<extra></extra>'),
+                      row=2, col=1)
+        # Category positions of the heatmap are 0, 1, 2..., the leaf coordinates of the dendrogram
+        sample_range = [-0.5, len(samples) - 0.5]
+        fig.update_xaxes(type='category', range=sample_range, tickangle=90, tickfont=dict(size=font_size),
+                         row=2, col=1)
+        fig.update_xaxes(range=sample_range, showticklabels=False, showgrid=False, zeroline=False, row=1, col=1)
+        fig.update_yaxes(type='category', autorange='reversed', tickfont=dict(size=font_size), row=2, col=1)
+        fig.update_yaxes(showticklabels=False, showgrid=False, row=1, col=1)
+        fig.update_layout({'paper_bgcolor': 'rgba(0,0,0,0)', 'plot_bgcolor': 'rgba(0,0,0,0)'},
+                          width=w, height=h)
+        return fig
 
     def get_principal_components(self, numPCs, numGenes, chooseBy):
         """
-        :param numPCs:
-        :param numGenes:
-        :param chooseBy:
-        :return:
+        PCA of samples over the top numGenes barcodes. Fits are memoized on (normalized matrix, numGenes, numPCs,
+        chooseBy), so reruns that only change axes, colors or symbols reuse the fit.
+        Uses randomized SVD once the number of barcodes reaches eda.pca.randomized_min_features.
+        :param numPCs: number of principal components
+        :param numGenes: number of barcodes to use, all barcodes if 0 or None
+        :param chooseBy: how to choose the barcodes, only 'variance' is implemented
+        :return: data frame of PCs and sample data per sample, % variance explained per PC
         """
-        pcaDf = self.norm_counts.set_index(self.barcode_col).copy()
-        pcaDf = pcaDf.drop(self.gene_name_col, axis=1)
-        pcaSd = self.sample_data.set_index(self.sample_id_col).apply(lambda x: x.astype('category'))
+        pca_key = (self.norm_key, numGenes, numPCs, chooseBy)
+        if pca_key not in self._pca_cache:
+            self._pca_cache[pca_key] = self._fit_principal_components(numPCs, numGenes, chooseBy)
+        pcDf, pcVar = self._pca_cache[pca_key]
+        return pcDf.copy(), dict(pcVar)
+
+    def _fit_principal_components(self, numPCs, numGenes, chooseBy):
+        rows = None
         if numGenes:
             # calculate var for each, pick numGenes top var across samples -> df
             if chooseBy == 'variance':
-                genes = pcaDf.var(axis=1).sort_values(ascending=False).head(int(numGenes)).index
-                pcaDf = pcaDf.loc[genes].T
+                rows = self.get_top_variance_rows(int(numGenes))
             else:
                 pass
                 # todo implement log2fc selection
+        pcaDf = pd.DataFrame(self.get_normalized_rows(rows).T, index=self.norm_samples)
+        pcaSd = self.sample_data.set_index(self.sample_id_col).apply(lambda x: x.astype('category'))
+        if pcaDf.shape[1] >= self.pca_randomized_min_features:
+            pca = PCA(n_components=numPCs, svd_solver='randomized', random_state=0)
         else:
-            pcaDf = pcaDf.T
-        pca = PCA(n_components=numPCs)
+            pca = PCA(n_components=numPCs, svd_solver='full')
         principalComponents = pca.fit_transform(pcaDf)
         pcs = [f'PC{i}' for i in range(1, numPCs + 1)]
         pcDf = (pd.DataFrame(data=principalComponents, columns=pcs)
@@ -251,9 +1565,9 @@ class CountDataSet:
                                                 color='DarkSlateGrey'), opacity=0.9),
                           selector=dict(mode='markers'))
         fig.update_xaxes(showline=True, linewidth=2, linecolor='black',
-                         tickfont=dict(size=font_size-6, color='black'), titlefont=dict(size=font_size, color='black'))
+                         tickfont=dict(size=font_size-6, color='black'), title_font=dict(size=font_size, color='black'))
         fig.update_yaxes(showline=True, linewidth=2, linecolor='black',
-                         tickfont=dict(size=font_size-6, color='black'), titlefont=dict(size=font_size, color='black'))
+                         tickfont=dict(size=font_size-6, color='black'), title_font=dict(size=font_size, color='black'))
         fig.update_layout(legend=dict(font=dict(size=font_size)), legend_title=dict(font=dict(size=font_size)))
         percent_variance_df = pd.DataFrame.from_dict(percent_variance, orient='index').reset_index()
         percent_variance_df.columns = ['PC', '% Variance']
@@ -267,13 +1581,15 @@ class CountDataSet:
         fig3 = px.imshow(pc_summary)
         return fig, fig2, fig3
 
-    def barcode_abundance_plot(self, geneDf, groupBy, colorBy, colorSeq, box=True):
+    def barcode_abundance_plot(self, geneDf, groupBy, colorBy, colorSeq, box=True, summarize=False):
+        if summarize:
+            return self.barcode_abundance_summary_plot(geneDf, groupBy, colorBy, colorSeq, box=box)
         if box:
-            fig = px.box(geneDf, x=groupBy, y='log2CPM', color=colorBy,
+            fig = px.box(geneDf, x=groupBy, y=self.norm_value_col, color=colorBy,
                          hover_data=geneDf.columns, points='all',
                          color_discrete_sequence=colorSeq, )
         else:
-            fig = px.violin(geneDf, x=groupBy, y='log2CPM', color=colorBy,
+            fig = px.violin(geneDf, x=groupBy, y=self.norm_value_col, color=colorBy,
                             hover_data=geneDf.columns, points='all',
                             color_discrete_sequence=colorSeq, )
         fig.update_layout({'paper_bgcolor': 'rgba(0,0,0,0)', 'plot_bgcolor': 'rgba(0,0,0,0)'}, autosize=True,
@@ -281,6 +1597,70 @@ class CountDataSet:
         fig.update_yaxes(showgrid=True, gridwidth=0.5, gridcolor='LightGrey')
         return fig
 
+    def barcode_abundance_summary_plot(self, geneDf, groupBy, colorBy, colorSeq, box=True, seed=0):
+        """
+        Box or violin plot drawn from statistics computed here (quartiles, whiskers, KDE curves), with at most
+        abundance_max_points random points overlaid, so the browser does not receive every (barcode, sample) value.
+        Groups and colors keep their order of appearance, as in plotly express.
+        """
+        group_codes, groups = pd.factorize(geneDf[groupBy])
+        color_codes, colors = pd.factorize(geneDf[colorBy])
+        values = geneDf[self.norm_value_col].to_numpy(dtype=np.float64)
+        # Boxes of one group are laid side by side, one slot per color; no genes selected gives an empty figure
+        slot_width = 0.8 / max(len(colors), 1)
+        centers = np.arange(len(groups))[:, None] - 0.4 + (np.arange(len(colors))[None, :] + 0.5) * slot_width
+        combo_codes = group_codes * len(colors) + color_codes
+        order = np.argsort(combo_codes, kind='stable')
+        offsets = np.searchsorted(combo_codes[order], np.arange(len(groups) * len(colors) + 1))
+        fig = go.Figure()
+        for color_code, color in enumerate(colors):
+            marker_color = colorSeq[color_code % len(colorSeq)]
+            group_stats = {}
+            for group_code in range(len(groups)):
+                combo = group_code * len(colors) + color_code
+                if offsets[combo + 1] > offsets[combo]:
+                    group_stats[group_code] = summarize_distribution(
+                        values[order[offsets[combo]:offsets[combo + 1]]], self.abundance_kde_points)
+            if not group_stats:
+                continue
+            if box:
+                fig.add_trace(go.Box(x=[centers[g, color_code] for g in group_stats],
+                                     **{stat: [group_stats[g][stat] for g in group_stats]
+                                        for stat in ('q1', 'median', 'q3', 'mean', 'lowerfence', 'upperfence')},
+                                     width=slot_width * 0.9, name=str(color), legendgroup=str(color),
+                                     marker_color=marker_color))
+            else:
+                for i, (group_code, stats) in enumerate(group_stats.items()):
+                    half_width = stats['kde_density'] / stats['kde_density'].max() * slot_width * 0.45
+                    center = centers[group_code, color_code]
+                    fig.add_trace(go.Scatter(x=np.concatenate([center + half_width, (center - half_width)[::-1]]),
+                                             y=np.concatenate([stats['kde_y'], stats['kde_y'][::-1]]),
+                                             fill='toself', mode='lines', line=dict(color=marker_color),
+                                             name=str(color), legendgroup=str(color), showlegend=i == 0,
+                                             hoverinfo='skip'))
+        rng = np.random.default_rng(seed)
+        shown = np.sort(rng.choice(len(geneDf), min(len(geneDf), self.abundance_max_points), replace=False))
+        jitter = rng.uniform(-0.3, 0.3, shown.size) * slot_width
+        hover_cols = [self.barcode_col, self.gene_name_col, self.sample_id_col]
+        for color_code, color in enumerate(colors):
+            in_color = color_codes[shown] == color_code
+            points = shown[in_color]
+            if not points.size:
+                continue
+            fig.add_trace(go.Scatter(x=centers[group_codes[points], color_code] + jitter[in_color],
+                                     y=values[points], mode='markers', name=str(color), legendgroup=str(color),
+                                     showlegend=False, marker=dict(color=colorSeq[color_code % len(colorSeq)],
+                                                                   size=4, opacity=0.6),
+                                     customdata=geneDf.iloc[points][hover_cols].to_numpy(),
+                                     hovertemplate='<br>'.join(f'{col}: %{{customdata[{i}]}}'
+                                                               for i, col in enumerate(hover_cols))
+                                                   + f'<br>{self.norm_value_col}: %{{y:.2f}}<extra></extra>'))
+        fig.update_xaxes(tickvals=list(range(len(groups))), ticktext=[str(g) for g in groups], title=groupBy)
+        fig.update_layout({'paper_bgcolor': 'rgba(0,0,0,0)', 'plot_bgcolor': 'rgba(0,0,0,0)'}, autosize=True,
+                          font=dict(size=16), yaxis_title=self.norm_value_col, legend_title=colorBy)
+        fig.update_yaxes(showgrid=True, gridwidth=0.5, gridcolor='LightGrey')
+        return fig
+
 
 class ResultDataSet:
     def __init__(self, result_files=(), config_file="scripts/config.yaml",
@@ -289,7 +1669,6 @@ class ResultDataSet:
         self.gene_id: str = gene_id
         self.results_df = pd.DataFrame()
         self.subset_df = pd.DataFrame()
-        self.hit_df = pd.DataFrame()
         with open(config_file, 'r') as cf:
             config = yaml.load(cf, Loader=yaml.SafeLoader)['results']
         col_name_config = config['fixed_column_names']
@@ -298,9 +1677,39 @@ class ResultDataSet:
         self.fdr_col2 = col_name_config['fdr_col2']
         self.contrast_col = col_name_config['contrast_col']
         self.library_col = col_name_config['library_col']
+        self.validation_mode = config['validation']['mode']
+        self.validation_sample_size = config['validation']['sample_size']
+        if self.validation_mode not in VALIDATION_MODES:
+            raise ValueError(f"Unknown validation mode {self.validation_mode}, choose one of {VALIDATION_MODES}")
+        self.validation_time = 0.0
         self.string_df = pd.DataFrame()
         self.kegg_df = pd.DataFrame()
         self.alphabet_clrs, self.app_colors, self.all_clrs = define_color_scheme()
+        # Hit engine: LFC and FDR sorted once per (library, contrast), cached against the results_df object
+        self._hit_index = (None, None)
+        # Threshold-independent (gene, contrast) aggregates, cached against the results_df object
+        self._gene_aggregates = (None, None)
+        # Dense gene x contrast LFC_median matrix per library selection, cached against the results_df object
+        self._lfc_matrices = (None, {})
+        # (library selection, genes, contrasts, metric) -> (gene linkage, contrast linkage), cached against results_df
+        self._heatmap_linkages = (None, {})
+        # Rank order of the last table drawn, cached against the results_df object and library selection
+        # (or the kegg_df object)
+        self._rank_table = (None, None, None)
+        # Rank plots with more points than this are drawn with WebGL, thinning out non-hits
+        self.rank_webgl_min_points = config['rank_plot']['webgl_min_points']
+        self.rank_max_points = config['rank_plot']['max_points']
+        self.rank_extreme_points = config['rank_plot']['extreme_points']
+        self.max_cached_hit_masks = config['hits']['max_cached_masks']
+        self._hit_masks = {}
+        # Hit mask and settings of the last identify_hits call, and the results table they were called on;
+        # hit_df is built from them on first access
+        self.hit_mask = None
+        self.hit_settings = None
+        self._hit_results_df = None
+        self._hit_df = None
+        # Library selection -> hit table without hit calls, cached against the results_df object
+        self._hit_tables = (None, {})
 
     def load_results(self):
         results_df_list = []
@@ -327,8 +1736,8 @@ class ResultDataSet:
         except ValueError:
             st.error('No result files loaded')
 
-    def validate_results_df(self):
-        results_schema = pa.DataFrameSchema({
+    def _results_schema(self) -> pa.DataFrameSchema:
+        return pa.DataFrameSchema({
             self.lfc_col: pa.Column(float, coerce=True),
             self.fdr_col: pa.Column(float, coerce=True),
             self.fdr_col2: pa.Column(float, coerce=True),
@@ -336,37 +1745,276 @@ class ResultDataSet:
             self.library_col: pa.Column(str, coerce=True),
             'fdr': pa.Column(float),
             '-log10FDR': pa.Column(float)})
+
+    def _check_results_df(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Fast counterpart of the pandera schema: dtype coercion only where needed, plus one NaN reduction per column
+        """
+        float_cols = [self.lfc_col, self.fdr_col, self.fdr_col2, 'fdr', '-log10FDR']
+        text_cols = [self.contrast_col, self.library_col]
+        missing_cols = [c for c in float_cols + text_cols if c not in df.columns]
+        if missing_cols:
+            raise ValueError(f"Missing columns: {', '.join(missing_cols)}")
+        df = df.astype({c: float for c in float_cols if not pd.api.types.is_float_dtype(df[c])})
+        df = df.astype({c: str for c in text_cols
+                        if not (pd.api.types.is_object_dtype(df[c]) or pd.api.types.is_string_dtype(df[c]))})
+        for col in float_cols + text_cols:
+            if df[col].isna().any():
+                raise ValueError(f"Column '{col}' has missing values")
+        return df
+
+    def validate_results_df(self):
+        start_time = time.perf_counter()
         try:
-            self.results_df = results_schema.validate(self.results_df)
-        except SchemaError as err:
+            if self.validation_mode == 'full':
+                self.results_df = self._results_schema().validate(self.results_df)
+            else:
+                if self.validation_mode == 'sampled':
+                    self._results_schema().validate(
+                        self.results_df.sample(n=min(self.validation_sample_size, len(self.results_df)),
+                                               random_state=0))
+                self.results_df = self._check_results_df(self.results_df)
+        except (SchemaError, ValueError) as err:
             st.error(f"""Schema Error: {err.args[0]}""")
+        self.validation_time = time.perf_counter() - start_time
+        st.write(f"_Validated results in {self.validation_time:.2f} s ({self.validation_mode} mode)_")
+        self.index_results()
+
+    def index_results(self):
+        """
+        Build the hit engine's sorted LFC and FDR index and the (gene, contrast) aggregates up front, so the first
+        hit threshold does not pay for them. Call again after replacing results_df (e.g. after merging annotations).
+        """
+        if not self.results_df.empty:
+            self._get_hit_index()
+            self._get_gene_aggregates()
+
+    def _get_hit_index(self) -> dict:
+        """
+        LFC and FDR of the result rows sorted once per (library, contrast): one stable order per column, grouped by
+        (library, contrast) code, with group offsets and the end of the non-NaN values of each group.
+        Rebuilt only when results_df is replaced (e.g. after merging annotations).
+        """
+        cached_df, hit_index = self._hit_index
+        if cached_df is not self.results_df:
+            group_codes, groups = pd.factorize(pd.MultiIndex.from_frame(
+                self.results_df[[self.library_col, self.contrast_col]]), use_na_sentinel=False)
+            hit_index = {'group_codes': group_codes, 'groups': groups}
+            for col in (self.lfc_col, 'fdr'):
+                values = self.results_df[col].to_numpy(dtype=np.float64)
+                # lexsort puts NaNs last within each group
+                order = np.lexsort((values, group_codes))
+                offsets = np.searchsorted(group_codes[order], np.arange(len(groups) + 1))
+                n_valid = np.bincount(group_codes[~np.isnan(values)], minlength=len(groups))
+                hit_index[col] = (order, values[order], offsets, offsets[:-1] + n_valid)
+            self._hit_index = (self.results_df, hit_index)
+            self._hit_masks = {}
+        return hit_index
+
+    def _get_gene_aggregates(self) -> dict:
+        """
+        Median LFC and number of libraries per (gene, contrast), keyed by (gene, contrast) codes,
+        with the code of every result row. Rebuilt only when results_df is replaced.
+        """
+        cached_df, gene_aggregates = self._gene_aggregates
+        if cached_df is not self.results_df:
+            key_codes, keys = pd.factorize(pd.MultiIndex.from_frame(
+                self.results_df[[self.gene_id, self.contrast_col]]), use_na_sentinel=False)
+            library_codes = pd.factorize(self.results_df[self.library_col], use_na_sentinel=False)[0]
+            aggregate_df = (pd.DataFrame({'key': key_codes, 'LFC': self.results_df[self.lfc_col].to_numpy(),
+                                          'library': library_codes})
+                            .groupby('key', sort=True)
+                            .agg(LFC_median=('LFC', 'median'), library_nunique=('library', 'nunique')))
+            aggregate_df.index = keys
+            gene_aggregates = {'key_codes': key_codes, 'table': aggregate_df}
+            self._gene_aggregates = (self.results_df, gene_aggregates)
+        return gene_aggregates
+
+    def _sorted_range(self, col, low=None, high=None):
+        """
+        Per (library, contrast), start and end positions in the sorted order of col of the values strictly
+        between low and high (None for no bound), by binary search. NaNs are never in range.
+        """
+        order, sorted_values, offsets, valid_ends = self._get_hit_index()[col]
+        starts, ends = offsets[:-1].astype(np.int64), valid_ends.astype(np.int64)
+        for group, (start, end) in enumerate(zip(offsets[:-1], valid_ends)):
+            group_values = sorted_values[start:end]
+            if low is not None:
+                starts[group] = start + np.searchsorted(group_values, low, side='right')
+            if high is not None:
+                ends[group] = start + np.searchsorted(group_values, high, side='left')
+        return starts, ends
+
+    def _range_mask(self, col, ranges) -> np.ndarray:
+        """
+        Boolean mask over result rows of the sorted positions covered by (starts, ends) ranges
+        """
+        order = self._get_hit_index()[col][0]
+        marks = np.zeros(order.size + 1, dtype=np.int32)
+        for starts, ends in ranges:
+            np.add.at(marks, starts, 1)
+            np.add.at(marks, ends, -1)
+        mask = np.empty(order.size, dtype=bool)
+        mask[order] = np.cumsum(marks[:-1]) > 0
+        return mask
+
+    def get_hit_mask(self, lfc_low, lfc_hi, fdr_th) -> np.ndarray:
+        """
+        Hits over result rows: |LFC| > lfc_low (or lfc_low < LFC < lfc_hi) and FDR < fdr_th.
+        Thresholds resolve to ranges of the presorted LFC and FDR arrays, intersected as boolean masks;
+        masks are cached per thresholds, so returning to earlier thresholds is a lookup.
+        """
+        mask_key = (lfc_low, lfc_hi, fdr_th)
+        self._get_hit_index()
+        if mask_key not in self._hit_masks:
+            if not lfc_hi and lfc_low < 0:
+                # |LFC| > a negative cutoff holds for every tested LFC
+                lfc_ranges = [self._sorted_range(self.lfc_col)]
+            elif not lfc_hi:
+                lfc_ranges = [self._sorted_range(self.lfc_col, high=-lfc_low),
+                              self._sorted_range(self.lfc_col, low=lfc_low)]
+            else:
+                lfc_ranges = [self._sorted_range(self.lfc_col, low=lfc_low, high=lfc_hi)]
+            fdr_ranges = [self._sorted_range('fdr', high=fdr_th)]
+            if len(self._hit_masks) >= self.max_cached_hit_masks:
+                self._hit_masks.pop(next(iter(self._hit_masks)))
+            self._hit_masks[mask_key] = self._range_mask(self.lfc_col, lfc_ranges) & self._range_mask('fdr', fdr_ranges)
+        return self._hit_masks[mask_key]
+
+    def get_hit_counts(self, lfc_low, lfc_hi, fdr_th) -> pd.DataFrame:
+        """
+        Number of hits per (library, contrast)
+        """
+        hit_index = self._get_hit_index()
+        hits = np.bincount(hit_index['group_codes'][self.get_hit_mask(lfc_low, lfc_hi, fdr_th)],
+                           minlength=len(hit_index['groups']))
+        hit_counts = hit_index['groups'].to_frame(index=False)
+        hit_counts.columns = [self.library_col, self.contrast_col]
+        return hit_counts.assign(hits=hits)
 
     def identify_hits(self, library_to_show, lfc_low, lfc_hi, fdr_th):
-        self.hit_df = self.results_df.copy()
-        if not lfc_hi:
-            self.hit_df['hit'] = ((abs(self.hit_df[self.lfc_col]) > lfc_low)
-                                      & (self.hit_df['fdr'] < fdr_th))
-        else:
-            self.hit_df['hit'] = ((self.hit_df[self.lfc_col] > lfc_low) &
-                                      (self.hit_df[self.lfc_col] < lfc_hi) &
-                                      (self.hit_df['fdr'] < fdr_th))
-        if 'LFC_median' in self.hit_df.columns:
-            self.hit_df = self.hit_df.drop('LFC_median', axis=1)
-        if library_to_show != 'All':
-            self.hit_df = self.hit_df[self.hit_df[self.library_col] == library_to_show]
-            self.hit_df['LFC_median'] = self.hit_df['LFC']
-            self.hit_df['library_nunique'] = 1
-            self.hit_df['hit_sum'] = self.hit_df['hit']
-        else:
-            df_grouped = (self.hit_df.groupby([self.gene_id, self.contrast_col])
-                          .agg({self.lfc_col: ['median'], self.library_col: ['nunique'],
-                                'hit': ['sum']})
-                          .reset_index())
-            df_grouped.columns = [self.gene_id, self.contrast_col, 'LFC_median', 'library_nunique', 'hit_sum']
+        """
+        Call hits for the given thresholds; the results table is not copied until hit_df is accessed.
+        Reruns with the same library, thresholds and results table keep the current hit_df.
+        """
+        hit_settings = (library_to_show, lfc_low, lfc_hi, fdr_th)
+        if hit_settings == self.hit_settings and self._hit_results_df is self.results_df:
+            return
+        self.hit_mask = self.get_hit_mask(lfc_low, lfc_hi, fdr_th)
+        self.hit_settings = hit_settings
+        self._hit_results_df = self.results_df
+        self._hit_df = None
+        self.get_lfc_matrix(library_to_show)
 
-            self.hit_df = self.hit_df.merge(df_grouped, on=[self.gene_id, self.contrast_col], how='left')
+    def get_lfc_matrix(self, library_to_show='All') -> dict:
+        """
+        LFC_median of every gene (rows, sorted) in every contrast (columns, sorted) as one dense matrix, NaN where a
+        gene was not tested. It does not depend on hit thresholds, so it is built once per library selection.
+        For 'All' it comes from the (gene, contrast) aggregates; for one library, duplicated gene names are
+        summarized by their median LFC.
+        """
+        cached_df, lfc_matrices = self._lfc_matrices
+        if cached_df is not self.results_df:
+            lfc_matrices = {}
+            self._lfc_matrices = (self.results_df, lfc_matrices)
+        if library_to_show not in lfc_matrices:
+            if library_to_show == 'All':
+                aggregate_df = self._get_gene_aggregates()['table']
+                gene_names = aggregate_df.index.get_level_values(0)
+                contrast_names = aggregate_df.index.get_level_values(1)
+                lfc = aggregate_df['LFC_median'].to_numpy(dtype=np.float64)
+            else:
+                library_df = self.results_df[self.results_df[self.library_col] == library_to_show]
+                gene_names, contrast_names = library_df[self.gene_id], library_df[self.contrast_col]
+                lfc = library_df[self.lfc_col].to_numpy(dtype=np.float64)
+            gene_codes, genes = pd.factorize(gene_names, sort=True)
+            contrast_codes, contrasts = pd.factorize(contrast_names, sort=True)
+            matrix = np.full((len(genes), len(contrasts)), np.nan)
+            if library_to_show == 'All':
+                matrix[gene_codes, contrast_codes] = lfc
+            else:
+                cell_codes, cells = pd.factorize(gene_codes * len(contrasts) + contrast_codes)
+                cell_lfc = pd.Series(lfc).groupby(cell_codes).median().to_numpy()
+                matrix.flat[cells] = cell_lfc
+            lfc_matrices[library_to_show] = {'genes': pd.Index(genes), 'contrasts': pd.Index(contrasts),
+                                             'matrix': matrix}
+        return lfc_matrices[library_to_show]
 
-    def graph_by_rank(self, contrast=(), kegg=False):
+    def _lfc_heat_df(self, genes, labels=None) -> pd.DataFrame:
+        """
+        Rows of the LFC matrix of the current library selection for genes, gathered by gene code; genes not in the
+        matrix get empty rows when labels are given, and are dropped otherwise
+        """
+        library_to_show = self.hit_settings[0] if self.hit_settings else 'All'
+        lfc_matrix = self.get_lfc_matrix(library_to_show)
+        gene_codes = lfc_matrix['genes'].get_indexer(genes)
+        if labels is None:
+            gene_codes = np.unique(gene_codes[gene_codes >= 0])
+            labels = lfc_matrix['genes'][gene_codes]
+        values = np.full((len(gene_codes), len(lfc_matrix['contrasts'])), np.nan)
+        found = gene_codes >= 0
+        values[found] = lfc_matrix['matrix'][gene_codes[found]]
+        heat_df = pd.DataFrame(values, index=labels, columns=lfc_matrix['contrasts'])
+        heat_df.columns.name = self.contrast_col
+        return heat_df.loc[:, heat_df.notna().any(axis=0)]
+
+    @property
+    def hit_df(self) -> pd.DataFrame:
+        """
+        Results with hit calls and cross-library aggregates for the last identify_hits call. The table of each
+        library selection is built once per results table; new thresholds only rewrite its hit and hit_sum columns.
+        """
+        if self._hit_df is None:
+            self._hit_df = self._update_hit_table()
+        return self._hit_df
+
+    def _get_hit_table(self, library_to_show) -> dict:
+        """
+        Threshold-independent part of hit_df for one library selection: the result rows with LFC_median and
+        library_nunique, and the positions of those rows in results_df
+        """
+        cached_df, hit_tables = self._hit_tables
+        if cached_df is not self.results_df:
+            hit_tables = {}
+            self._hit_tables = (self.results_df, hit_tables)
+        if library_to_show not in hit_tables:
+            hit_df = self.results_df.assign(hit=False)
+            if 'LFC_median' in hit_df.columns:
+                hit_df = hit_df.drop('LFC_median', axis=1)
+            if library_to_show != 'All':
+                rows = np.flatnonzero(hit_df[self.library_col].to_numpy() == library_to_show)
+                hit_df = hit_df.iloc[rows].copy()
+                hit_df['LFC_median'] = hit_df['LFC']
+                hit_df['library_nunique'] = 1
+                hit_df['hit_sum'] = hit_df['hit']
+            else:
+                rows = None
+                gene_aggregates = self._get_gene_aggregates()
+                key_codes, aggregate_df = gene_aggregates['key_codes'], gene_aggregates['table']
+                hit_df = hit_df.assign(LFC_median=aggregate_df['LFC_median'].to_numpy()[key_codes],
+                                       library_nunique=aggregate_df['library_nunique'].to_numpy()[key_codes],
+                                       hit_sum=np.zeros(len(hit_df), dtype=np.int64)).reset_index(drop=True)
+            hit_tables[library_to_show] = {'table': hit_df, 'rows': rows}
+        return hit_tables[library_to_show]
+
+    def _update_hit_table(self) -> pd.DataFrame:
+        if self.hit_mask is None:
+            return pd.DataFrame()
+        hit_table = self._get_hit_table(self.hit_settings[0])
+        hit_df, rows = hit_table['table'], hit_table['rows']
+        if rows is not None:
+            hit_df['hit'] = self.hit_mask[rows]
+            hit_df['hit_sum'] = hit_df['hit']
+        else:
+            key_codes = self._get_gene_aggregates()['key_codes']
+            hit_sum = np.bincount(key_codes, weights=self.hit_mask, minlength=key_codes.max(initial=-1) + 1)
+            hit_df['hit'] = self.hit_mask
+            hit_df['hit_sum'] = hit_sum.astype(np.int64)[key_codes]
+        return hit_df
+
+    def graph_by_rank(self, contrast=(), kegg=False, webgl=False):
+        if webgl:
+            return self.graph_by_rank_gl(contrast, kegg)
         rank_df = self.kegg_df if kegg else self.hit_df
         if contrast:
             rank_df = rank_df[rank_df[self.contrast_col].isin(contrast)]
@@ -396,48 +2044,210 @@ class ResultDataSet:
                           selector=dict(mode='markers'))
         return fig
 
-    def graph_heatmap(self, genes, font_size=24):
-        heat_df = (self.hit_df[self.hit_df[self.gene_id].isin(genes)][[self.gene_id, self.contrast_col, 'LFC_median']]
-                   .drop_duplicates()
-                   .pivot(index=self.gene_id, columns=self.contrast_col, values='LFC_median'))
+    def _get_rank_table(self, kegg=False) -> dict:
+        """
+        Unique (gene, contrast, LFC_median, fdr) rows of the hit table sorted by LFC_median, with contrast codes and
+        the unique row of every hit table row. Subsetting to some contrasts keeps the order, so their ranks need no
+        further sort. Hit thresholds do not change the order, so it is built once per results table and library
+        selection (or per kegg_df), and hit calls are gathered through it on each draw.
+        """
+        if kegg:
+            source_df, library_to_show, hit_df = self.kegg_df, None, self.kegg_df
+        else:
+            library_to_show = self.hit_settings[0]
+            source_df, hit_df = self.results_df, self._get_hit_table(library_to_show)['table']
+        cached_df, cached_library, rank_table = self._rank_table
+        if rank_table is None or cached_df is not source_df or cached_library != library_to_show:
+            rank_cols = [self.gene_id, self.contrast_col, 'LFC_median', 'fdr']
+            row_codes, _ = pd.factorize(pd.MultiIndex.from_frame(hit_df[rank_cols]), use_na_sentinel=False)
+            # First row of each unique combination; codes follow order of appearance
+            first_rows = np.unique(row_codes, return_index=True)[1]
+            lfc = hit_df['LFC_median'].to_numpy(dtype=np.float64)[first_rows]
+            order = np.argsort(lfc, kind='stable')
+            rank_rows = first_rows[order]
+            contrast_codes, contrasts = pd.factorize(hit_df[self.contrast_col].to_numpy()[rank_rows], sort=True)
+            # Rank of each unique combination, to gather per-row hit calls into rank order
+            unique_ranks = np.empty(order.size, dtype=np.int64)
+            unique_ranks[order] = np.arange(order.size)
+            rank_table = {'contrast_codes': contrast_codes, 'contrasts': pd.Index(contrasts),
+                          'row_ranks': unique_ranks[row_codes],
+                          'gene': hit_df[self.gene_id].to_numpy()[rank_rows],
+                          'lfc': lfc[order],
+                          'fdr': hit_df['fdr'].to_numpy(dtype=np.float64)[rank_rows]}
+            self._rank_table = (source_df, library_to_show, rank_table)
+        return rank_table
+
+    def _rank_points(self, rank_table, kegg=False):
+        """
+        Points of the rank plot for the current hit calls, without re-sorting: one point per unique row and hit
+        value, as drop_duplicates over the hit table gives. A unique row with both hit and non-hit rows gives two
+        adjacent points, in order of their first row.
+        :return: unique row (rank order) of each point, hit call of each point
+        """
+        hits = (self.kegg_df if kegg else self.hit_df)['hit'].to_numpy(dtype=bool)
+        row_ranks, n_ranks = rank_table['row_ranks'], len(rank_table['lfc'])
+        first_rows = []
+        for variant in (hits, ~hits):
+            first_row = np.full(n_ranks, row_ranks.size)
+            np.minimum.at(first_row, row_ranks[variant], np.flatnonzero(variant))
+            first_rows.append(first_row)
+        has_hit, has_non_hit = first_rows[0] < row_ranks.size, first_rows[1] < row_ranks.size
+        point_ranks = np.repeat(np.arange(n_ranks), has_hit.astype(np.int64) + has_non_hit)
+        point_hits = np.repeat(has_hit & (first_rows[0] < first_rows[1]), has_hit.astype(np.int64) + has_non_hit)
+        # Second point of a unique row with both: the other hit value
+        second = np.r_[False, point_ranks[1:] == point_ranks[:-1]]
+        point_hits[second] = ~point_hits[np.flatnonzero(second) - 1]
+        return point_ranks, point_hits
+
+    def graph_by_rank_gl(self, contrast=(), kegg=False):
+        """
+        Rank plot drawn with WebGL from the presorted rank table. Every hit and the rank_extreme_points genes at
+        either end are drawn; the non-hits in between are thinned to at most rank_max_points evenly spaced ranks,
+        so the number of markers does not grow with the genome.
+        """
+        rank_table = self._get_rank_table(kegg)
+        point_ranks, point_hits = self._rank_points(rank_table, kegg)
+        contrasts = rank_table['contrasts']
+        if contrast:
+            selected = np.isin(rank_table['contrast_codes'][point_ranks], contrasts.get_indexer(list(contrast)))
+            point_ranks, point_hits = point_ranks[selected], point_hits[selected]
+        ranks = decimate_ranks(point_hits, self.rank_extreme_points, self.rank_max_points)
+        rows, rank_hits = point_ranks[ranks], point_hits[ranks]
+        symbols = ['circle', 'diamond', 'square', 'x', 'cross', 'triangle-up', 'triangle-down', 'star']
+        fig = go.Figure()
+        for hit in (False, True):
+            for code, contrast_name in enumerate(contrasts):
+                trace_mask = (rank_hits == hit) & (rank_table['contrast_codes'][rows] == code)
+                if not trace_mask.any():
+                    continue
+                trace_rows = rows[trace_mask]
+                fig.add_trace(go.Scattergl(
+                    x=ranks[trace_mask], y=rank_table['lfc'][trace_rows], mode='markers',
+                    name=f'{hit}, {contrast_name}',
+                    marker=dict(color=self.app_colors['darko'] if hit else self.app_colors['grey'],
+                                symbol=symbols[code % len(symbols)], size=14, opacity=0.8),
+                    customdata=np.column_stack([rank_table['gene'][trace_rows],
+                                                np.full(trace_mask.sum(), contrast_name, dtype=object),
+                                                rank_table['fdr'][trace_rows]]),
+                    hovertemplate=(f'<b>%{{customdata[0]}}</b><br>{self.contrast_col}=%{{customdata[1]}}'
+                                   f'<br>LFC_median=%{{y}}<br>fdr=%{{customdata[2]}}<extra></extra>')))
+        fig.add_hline(y=0, line_width=2, line_dash="dash", line_color="grey")
+        fig.update_xaxes(showticklabels=False)
+        fig.update_layout({'paper_bgcolor': 'rgba(0,0,0,0)', 'plot_bgcolor': 'rgba(0,0,0,0)'}, autosize=True,
+                          font=dict(size=18), height=500, yaxis_title='LFC', legend_title=f'hit, {self.contrast_col}')
+        return fig
+
+    def get_heatmap_linkage(self, heat_df, metric='euclidean'):
+        """
+        Average-linkage clustering of the genes (rows) and contrasts (columns) of a heatmap, with untested genes
+        counted as LFC 0. Memoized per (library selection, genes, contrasts, metric), so toggling the clustered
+        view or revisiting a gene set does not recluster.
+        :param metric: 'euclidean' or 'correlation'
+        :return: gene linkage matrix, contrast linkage matrix; None for an axis with fewer than 2 entries
+        """
+        if metric not in HEATMAP_CLUSTER_METRICS:
+            raise ValueError(f"Unknown metric {metric}, choose one of {', '.join(HEATMAP_CLUSTER_METRICS)}")
+        cached_df, heatmap_linkages = self._heatmap_linkages
+        if cached_df is not self.results_df:
+            heatmap_linkages = {}
+            self._heatmap_linkages = (self.results_df, heatmap_linkages)
+        library_to_show = self.hit_settings[0] if self.hit_settings else 'All'
+        linkage_key = (library_to_show, tuple(heat_df.index), tuple(heat_df.columns), metric)
+        if linkage_key not in heatmap_linkages:
+            values = np.nan_to_num(heat_df.to_numpy(dtype=np.float64))
+            linkages = []
+            for axis_values in (values, values.T):
+                if len(axis_values) < 2:
+                    linkages.append(None)
+                    continue
+                # Constant rows have no correlation; treat them as uncorrelated with everything
+                distances = np.nan_to_num(pdist(axis_values, metric=metric), nan=1.0)
+                linkages.append(hierarchy.linkage(distances, method='average'))
+            heatmap_linkages[linkage_key] = tuple(linkages)
+        return heatmap_linkages[linkage_key]
+
+    def clustered_heatmap_figure(self, heat_df, metric='euclidean', w=1000, h=900, font_size=12):
+        """
+        LFC heatmap with genes and contrasts in clustering order, the gene dendrogram on the left and the
+        contrast dendrogram above, each drawn as a single trace
+        """
+        row_linkage, col_linkage = self.get_heatmap_linkage(heat_df, metric)
+        fig = make_subplots(rows=2, cols=2, row_heights=[0.15, 0.85], column_widths=[0.15, 0.85],
+                            horizontal_spacing=0.01, vertical_spacing=0.01)
+        orders = []
+        line = dict(mode='lines', line=dict(color='black', width=1), hoverinfo='skip', showlegend=False)
+        for axis, linkage in enumerate((row_linkage, col_linkage)):
+            if linkage is None:
+                orders.append(np.arange(heat_df.shape[axis]))
+                continue
+            leaves, leaf_coords, heights = dendrogram_lines(linkage)
+            orders.append(leaves)
+            if axis == 0:
+                fig.add_trace(go.Scatter(x=heights, y=leaf_coords, **line), row=2, col=1)
+            else:
+                fig.add_trace(go.Scatter(x=leaf_coords, y=heights, **line), row=1, col=2)
+        row_order, col_order = orders
+        heat_df = heat_df.iloc[row_order, col_order]
+        genes, contrasts = [str(g) for g in heat_df.index], [str(c) for c in heat_df.columns]
+        fig.add_trace(go.Heatmap(z=heat_df.to_numpy(), x=contrasts, y=genes,
+                                 colorscale=px.colors.diverging.Geyser, zmid=0, colorbar=dict(title='LFC'),
+                                 hovertemplate='%{y}<br>%{x}<br>LFC = %{z:.2f}<extra></extra>'),
+                      row=2, col=2)
+        # Category positions of the heatmap are 0, 1, 2..., the leaf coordinates of the dendrograms
+        gene_range, contrast_range = [-0.5, len(genes) - 0.5], [-0.5, len(contrasts) - 0.5]
+        fig.update_xaxes(type='category', range=contrast_range, tickangle=90, tickfont=dict(size=font_size),
+                         row=2, col=2)
+        fig.update_yaxes(type='category', range=gene_range, side='right', tickfont=dict(size=font_size),
+                         row=2, col=2)
+        # Root of the gene dendrogram on the left
+        fig.update_xaxes(showticklabels=False, showgrid=False, zeroline=False, autorange='reversed', row=2, col=1)
+        fig.update_yaxes(range=gene_range, showticklabels=False, showgrid=False, zeroline=False, row=2, col=1)
+        fig.update_xaxes(range=contrast_range, showticklabels=False, showgrid=False, zeroline=False, row=1, col=2)
+        fig.update_yaxes(showticklabels=False, showgrid=False, row=1, col=2)
+        fig.update_layout({'paper_bgcolor': 'rgba(0,0,0,0)', 'plot_bgcolor': 'rgba(0,0,0,0)'},
+                          width=w, height=h)
+        return fig
+
+    def graph_heatmap(self, genes, font_size=24, cluster=False, metric='euclidean'):
+        heat_df = self._lfc_heat_df(genes)
         heat_df.index.name = 'Gene'
+        if cluster:
+            return self.clustered_heatmap_figure(heat_df, metric, font_size=font_size - 6)
         fig = px.imshow(heat_df, color_continuous_scale=px.colors.diverging.Geyser,
                         color_continuous_midpoint=0,
                         width=1000, height=900)
 
         fig.update_xaxes(showline=True, linewidth=2, linecolor='black',
                          tickfont=dict(size=font_size - 6, color='black'),
-                         titlefont=dict(size=font_size, color='black'), tickangle=90)
+                         title_font=dict(size=font_size, color='black'), tickangle=90)
         fig.update_yaxes(showline=True, linewidth=2, linecolor='black',
                          tickfont=dict(size=font_size - 6, color='black'),
-                         titlefont=dict(size=font_size, color='black'))
+                         title_font=dict(size=font_size, color='black'))
         fig.update_layout(legend=dict(font=dict(size=font_size - 2, color='black')),
                           coloraxis_colorbar=dict(title=dict(text='LFC', font=dict(size=font_size, color='black')),
                                                   tickfont=dict(size=font_size - 2, color='black')))
 
         return fig
 
-    def display_pathway_heatmap(self, pathway_gene_names, kegg_id):
+    def display_pathway_heatmap(self, pathway_gene_names, kegg_id, cluster=False, metric='euclidean'):
 
         if kegg_id not in self.results_df.columns:
             st.error(f"{kegg_id} not found in the results table")
         else:
-            heat_df = self.hit_df[self.hit_df[kegg_id].isin(pathway_gene_names)]
+            pathway_df = (self.hit_df.loc[self.hit_df[kegg_id].isin(pathway_gene_names), [self.gene_id, kegg_id]]
+                          .drop_duplicates())
             absent = pd.DataFrame(
-                pd.Series(list(set(pathway_gene_names) - set(heat_df[kegg_id].unique())), name=kegg_id))
-
-            heat_df = heat_df[list({self.gene_id, kegg_id, 'LFC_median', self.contrast_col})].drop_duplicates()
-            heat_df = pd.concat([heat_df, absent], axis=0)
-            gene_names = heat_df[self.gene_id].fillna('-').values
-            kegg_tags = heat_df[kegg_id].values
-
-            heat_df['Gene'] = [
+                pd.Series(list(set(pathway_gene_names) - set(pathway_df[kegg_id].unique())), name=kegg_id))
+            pathway_df = pd.concat([pathway_df, absent], axis=0)
+            gene_names = pathway_df[self.gene_id].fillna('-').values
+            kegg_tags = pathway_df[kegg_id].values
+            labels = pd.Index([
                 f"{tag}: {name}" if name != '-' and name != tag else f"{tag}" for
-                tag, name in zip(kegg_tags, gene_names)]
-
-
-            heat_df = heat_df.pivot(index='Gene', columns=self.contrast_col, values='LFC_median')
-
+                tag, name in zip(kegg_tags, gene_names)], name='Gene')
+            keep = ~labels.duplicated()
+            heat_df = self._lfc_heat_df(pathway_df[self.gene_id].to_numpy()[keep], labels[keep]).sort_index()
+            if cluster:
+                return self.clustered_heatmap_figure(heat_df, metric, font_size=10)
             fig = px.imshow(heat_df, color_continuous_scale=px.colors.diverging.Geyser,
                             color_continuous_midpoint=0,
                             width=1000, height=900)
@@ -1,5 +1,5 @@
 import streamlit as st
-from scripts.datasets import define_color_scheme
+from scripts.datasets import CORRELATION_METHODS, define_color_scheme
 
 ALPHABET_COLORS, APP_COLORS, ALL_COLORS = define_color_scheme()
 
@@ -11,8 +11,8 @@ def pca_layout(cds):
         c1, c2, c3, c4 = st.columns(4)
         num_components = c1.number_input("Number of PCs", min_value=2, max_value=50, value=10)
         num_genes = c2.number_input("Number of genes to use", min_value=int(num_components),
-                                    value=int(max(100, cds.count_data.shape[0] * 0.1)),
-                                    max_value=int(cds.count_data.shape[0]),
+                                    value=int(max(100, len(cds.barcodes) * 0.1)),
+                                    max_value=int(len(cds.barcodes)),
                                     help='By default, uses top 10% most variable barcodes')
         choose_by = 'variance'
         num_genes = int(num_genes)
@@ -46,6 +46,21 @@ def pca_layout(cds):
         c6.plotly_chart(fig3, use_container_width=True)
 
 
+def correlation_layout(cds):
+    st.write('## Sample Correlation')
+    with st.expander('Show Sample Correlation'):
+        c1, c2 = st.columns(2)
+        method = c1.radio('Correlation', CORRELATION_METHODS, format_func=str.capitalize, horizontal=True)
+        num_barcodes = c2.number_input("Number of barcodes to use", min_value=2,
+                                       value=int(len(cds.barcodes)), max_value=int(len(cds.barcodes)),
+                                       help='By default, uses all barcodes; fewer uses the most variable ones')
+        num_barcodes = int(num_barcodes) if num_barcodes < len(cds.barcodes) else None
+        corr_df, linkage = cds.get_sample_correlation(method, num_barcodes)
+        st.plotly_chart(cds.sample_correlation_figure(corr_df, linkage, method), use_container_width=True)
+        st.download_button('Download correlation matrix', corr_df.to_csv().encode('utf-8'),
+                           file_name=f'sample_{method}_correlation.csv', mime='text/csv')
+
+
 def barcode_abundance_layout(cds):
     st.write('## Barcode Abundance')
     with st.expander('Show Barcode Abundance'):
@@ -63,17 +78,16 @@ def barcode_abundance_layout(cds):
                                                list(cds.sample_data[filter_condition].unique()))
         if 'All' in condition_categories:
             condition_categories = list(cds.sample_data[compare_condition].unique())
-        default_genes =  [ex for ex in  ['dcuS', 'dcuR'] if ex in cds.count_data[cds.gene_name_col].unique()]
-        genes = st.multiselect("Choose gene(s) of interest", cds.count_data[cds.gene_name_col].unique(), default=default_genes)
+        gene_list = cds.get_gene_list()
+        default_genes =  [ex for ex in  ['dcuS', 'dcuR'] if ex in cds.genes.categories]
+        genes = st.multiselect("Choose gene(s) of interest", gene_list, default=default_genes)
         if len(genes) * len(condition_categories) > 40:
             st.write('Too many genes/categories to display, consider choosing fewer genes.')
         else:
-            gene_df = cds.count_data[cds.count_data[cds.gene_name_col].isin(genes)]
             ab_sample_df = cds.sample_data[cds.sample_data[compare_condition].isin(condition_categories)]
             if filter_categories:
                 ab_sample_df = ab_sample_df[ab_sample_df[filter_condition].isin(filter_categories)]
-            gene_df = (gene_df.melt(id_vars=[cds.barcode_col, cds.gene_name_col],
-                                    value_name='log2CPM', var_name=cds.sample_id_col)
+            gene_df = (cds.get_gene_abundance(genes)
                        .merge(ab_sample_df, how='inner', on=cds.sample_id_col)
                        .sort_values(compare_condition))
 
@@ -85,8 +99,13 @@ def barcode_abundance_layout(cds):
             box = "Box"
             violin = "Violin"
             plotType = col2.radio('Plot Type', (box, violin))
+            summarize = col2.checkbox('Summarize distributions on the server',
+                                      value=len(gene_df) > cds.abundance_summary_min_points,
+                                      help=f'Draws precomputed quartiles and densities with at most '
+                                           f'{cds.abundance_max_points} random points instead of every point')
             if plotType == box:
-                fig = cds.barcode_abundance_plot(gene_df, groupBy, colorBy, ALL_COLORS)
+                fig = cds.barcode_abundance_plot(gene_df, groupBy, colorBy, ALL_COLORS, summarize=summarize)
             if plotType == violin:
-                fig = cds.barcode_abundance_plot(gene_df, groupBy, colorBy, ALL_COLORS, box=False)
+                fig = cds.barcode_abundance_plot(gene_df, groupBy, colorBy, ALL_COLORS, box=False,
+                                                 summarize=summarize)
             st.plotly_chart(fig, use_container_width=True)
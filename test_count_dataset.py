@@ -0,0 +1,379 @@
+import numpy as np
+import pandas as pd
+import pytest
+import yaml
+from scipy import sparse
+from scipy.stats import gaussian_kde
+from scripts.datasets import (CountDataSet, CORRELATION_METHODS, NORMALIZATION_METHODS, column_quantiles,
+                              median_ratio_size_factors, summarize_distribution, tmm_factors)
+
+EXAMPLE_SAMPLE_DATA = 'examples/example_sample_data.csv'
+
+
+def write_count_table(path, n_barcodes=500, zero_fraction=0.8, seed=0):
+    """
+    Synthetic merged count table for the samples of the example sample data, mostly zeros,
+    with unannotated barcodes and a duplicated row
+    """
+    rng = np.random.default_rng(seed)
+    samples = pd.read_csv(EXAMPLE_SAMPLE_DATA).iloc[:, 0].tolist()
+    counts = rng.poisson(50, size=(n_barcodes, len(samples)))
+    counts[rng.random(counts.shape) < zero_fraction] = 0
+    count_df = pd.DataFrame(counts, columns=samples)
+    count_df.insert(0, 'barcode', [f'BC{i}' for i in range(n_barcodes)])
+    count_df.insert(1, 'Name', [f'gene{i // 5}' if i % 50 else np.nan for i in range(n_barcodes)])
+    count_df = pd.concat([count_df, count_df.iloc[[1]]], ignore_index=True)
+    count_df.to_csv(path, index=False)
+    return count_df
+
+
+@pytest.fixture
+def count_file(tmp_path):
+    path = tmp_path / 'counts.csv'
+    write_count_table(path)
+    return path
+
+
+def test_sparse_storage(count_file):
+    cds = CountDataSet(count_file, EXAMPLE_SAMPLE_DATA, storage='sparse')
+    expected = (pd.read_csv(count_file).rename({'Name': cds.gene_name_col}, axis=1)
+                .dropna(subset=[cds.gene_name_col]).drop_duplicates().reset_index(drop=True))
+    assert sparse.issparse(cds.counts) and cds.counts.format == 'csr'
+    assert cds.counts.dtype == np.int32
+    assert cds.counts.nnz < 0.3 * np.prod(cds.counts.shape)
+    pd.testing.assert_frame_equal(cds.count_data.astype({cds.gene_name_col: object}),
+                                  expected[cds.count_data.columns], check_dtype=False)
+
+
+def test_normalization_matches_dense(count_file):
+    sparse_cds = CountDataSet(count_file, EXAMPLE_SAMPLE_DATA, storage='sparse')
+    dense_cds = CountDataSet(count_file, EXAMPLE_SAMPLE_DATA, storage='dense')
+    for cds in (sparse_cds, dense_cds):
+        cds.normalize_counts()
+    count_df = dense_cds.count_data.set_index([dense_cds.barcode_col, dense_cds.gene_name_col])
+    count_df = count_df.loc[:, count_df.sum() > 0]
+    expected = np.log2((count_df / count_df.sum()) * 1000000 + 0.5)
+    for cds in (sparse_cds, dense_cds):
+        assert cds.norm_samples == list(expected.columns)
+        assert cds.norm_counts.dtype == np.float32
+        np.testing.assert_allclose(cds.get_normalized_rows(), expected.to_numpy(), rtol=1e-5, atol=1e-5)
+        np.testing.assert_allclose(cds.get_barcode_variance(), expected.var(axis=1).to_numpy(), rtol=1e-4)
+    sparse_pcs, sparse_var = sparse_cds.get_principal_components(3, 100, 'variance')
+    dense_pcs, dense_var = dense_cds.get_principal_components(3, 100, 'variance')
+    pd.testing.assert_frame_equal(sparse_pcs, dense_pcs, atol=1e-3)
+    assert sparse_var == pytest.approx(dense_var, abs=0.01)
+
+
+@pytest.mark.parametrize('storage', ['sparse', 'dense'])
+def test_normalization_skips_empty_samples(tmp_path, storage):
+    count_df = write_count_table(tmp_path / 'counts.csv')
+    empty_sample = count_df.columns[3]
+    count_df[empty_sample] = 0
+    count_df.to_csv(tmp_path / 'counts.csv', index=False)
+    cds = CountDataSet(tmp_path / 'counts.csv', EXAMPLE_SAMPLE_DATA, storage=storage)
+    cds.normalize_counts()
+    assert empty_sample not in cds.norm_samples
+    assert cds.get_normalized_rows().shape == (len(cds.barcodes), len(cds.samples) - 1)
+    assert np.isfinite(cds.get_normalized_rows()).all()
+
+
+def test_gene_abundance(count_file):
+    cds = CountDataSet(count_file, EXAMPLE_SAMPLE_DATA)
+    cds.normalize_counts()
+    gene_df = cds.get_gene_abundance(['gene3', 'gene7'])
+    assert set(gene_df[cds.gene_name_col]) == {'gene3', 'gene7'}
+    assert len(gene_df) == 10 * len(cds.norm_samples)
+    row = np.flatnonzero(cds.barcodes == 'BC16')[0]
+    values = gene_df.loc[gene_df[cds.barcode_col] == 'BC16', 'log2CPM'].to_numpy()
+    np.testing.assert_allclose(values, cds.get_normalized_rows([row])[0])
+
+
+@pytest.mark.parametrize('method', list(NORMALIZATION_METHODS))
+def test_normalization_methods_match_dense(count_file, method):
+    sparse_cds = CountDataSet(count_file, EXAMPLE_SAMPLE_DATA, storage='sparse')
+    dense_cds = CountDataSet(count_file, EXAMPLE_SAMPLE_DATA, storage='dense')
+    for cds in (sparse_cds, dense_cds):
+        cds.normalize_counts(method)
+    np.testing.assert_allclose(sparse_cds.get_normalized_rows(), dense_cds.get_normalized_rows(),
+                               rtol=1e-4, atol=1e-4)
+    np.testing.assert_allclose(sparse_cds.get_barcode_variance(), dense_cds.get_barcode_variance(),
+                               rtol=1e-3, atol=1e-5)
+    assert sparse_cds.norm_value_col == NORMALIZATION_METHODS[method]
+    assert NORMALIZATION_METHODS[method] in sparse_cds.get_gene_abundance(['gene3']).columns
+
+
+def test_median_ratio_size_factors():
+    rng = np.random.default_rng(1)
+    counts = rng.poisson(100, size=(200, 6)) * np.array([1, 2, 3, 1, 2, 3])
+    counts[:20, 0] = 0
+    complete = counts[(counts > 0).all(axis=1)]
+    log_ratios = np.log(complete) - np.log(complete).mean(axis=1, keepdims=True)
+    expected = np.exp(np.median(log_ratios, axis=0))
+    expected = expected / np.exp(np.log(expected).mean())
+    for matrix in (counts, sparse.csr_matrix(counts)):
+        np.testing.assert_allclose(median_ratio_size_factors(matrix), expected)
+    # No barcode counted in every sample: positive counts only
+    counts[np.arange(200), np.arange(200) % 6] = 0
+    np.testing.assert_allclose(median_ratio_size_factors(sparse.csr_matrix(counts)),
+                               median_ratio_size_factors(counts))
+
+
+def test_column_quantiles():
+    rng = np.random.default_rng(2)
+    counts = rng.poisson(3, size=(300, 5))
+    counts[rng.random(counts.shape) < 0.6] = 0
+    counts[:10] = 0
+    expected = np.quantile(counts[counts.any(axis=1)], 0.75, axis=0)
+    np.testing.assert_allclose(column_quantiles(sparse.csr_matrix(counts), 0.75), expected)
+    np.testing.assert_allclose(column_quantiles(counts, 0.75), expected)
+    positive = [np.quantile(c[c > 0], 0.5) for c in counts.T]
+    np.testing.assert_allclose(column_quantiles(sparse.csr_matrix(counts), 0.5, positive_only=True), positive)
+
+
+def test_tmm_factors_ignore_composition():
+    rng = np.random.default_rng(3)
+    counts = rng.poisson(200, size=(1000, 4))
+    # Same composition at different depths gives equal factors
+    scaled = counts * np.array([1, 2, 4, 8])
+    np.testing.assert_allclose(tmm_factors(scaled, scaled.sum(axis=0)), 1, rtol=0.02)
+    # A few barcodes taking over a sample are trimmed away
+    skewed = counts.copy()
+    skewed[:20, 3] *= 100
+    effective = skewed.sum(axis=0) * tmm_factors(skewed, skewed.sum(axis=0))
+    assert effective[3] / effective[0] == pytest.approx(counts[:, 3].sum() / counts[:, 0].sum(), rel=0.05)
+
+
+def test_clr_centers_samples(count_file):
+    cds = CountDataSet(count_file, EXAMPLE_SAMPLE_DATA)
+    cds.normalize_counts('clr', pseudocount=1)
+    np.testing.assert_allclose(cds.get_normalized_rows().mean(axis=0), 0, atol=1e-4)
+
+
+def test_normalization_cache(count_file):
+    cds = CountDataSet(count_file, EXAMPLE_SAMPLE_DATA)
+    cds.normalize_counts('cpm')
+    cpm_counts = cds.norm_counts
+    cds.normalize_counts('tmm')
+    assert cds.norm_counts is not cpm_counts
+    cds.normalize_counts('cpm')
+    assert cds.norm_counts is cpm_counts
+    assert len(cds._norm_cache) == 2
+    cds.normalize_counts('cpm', pseudocount=1)
+    assert len(cds._norm_cache) == 3
+    with pytest.raises(ValueError):
+        cds.normalize_counts('rpkm')
+
+
+def test_principal_components_cache(count_file, monkeypatch):
+    cds = CountDataSet(count_file, EXAMPLE_SAMPLE_DATA)
+    cds.normalize_counts()
+    pc_df, pc_var = cds.get_principal_components(3, 100, 'variance')
+    pc_df['PC1'] = 0
+    monkeypatch.setattr(cds, '_fit_principal_components', None)
+    cached_df, cached_var = cds.get_principal_components(3, 100, 'variance')
+    assert cached_var == pc_var
+    assert (cached_df['PC1'] != 0).any()
+    monkeypatch.undo()
+    cds.normalize_counts('tmm')
+    cds.get_principal_components(3, 100, 'variance')
+    assert len(cds._pca_cache) == 2
+
+
+def test_pca_figure(count_file):
+    cds = CountDataSet(count_file, EXAMPLE_SAMPLE_DATA)
+    cds.normalize_counts()
+    pc_df, pc_var = cds.get_principal_components(3, 100, 'variance')
+    experiment_vars = [c for c in pc_df.columns if not c.startswith('PC')]
+    fig, scree, summary = cds.pca_figure(pc_df, 'PC1', 'PC2', experiment_vars[0], pc_var, None, experiment_vars,
+                                         ['red', 'blue'])
+    assert sum(len(trace.x) for trace in fig.data) == len(pc_df)
+    assert fig.layout.xaxis.title.font.size == 24
+
+
+def test_randomized_principal_components(tmp_path):
+    count_df = write_count_table(tmp_path / 'counts.csv', zero_fraction=0)
+    rng = np.random.default_rng(4)
+    samples = count_df.columns[2:]
+    # Two groups of samples with barcode-specific fold changes, so the leading PCs are well separated
+    fold_changes = rng.lognormal(0, 3, size=(len(count_df), 1))
+    count_df[samples[::2]] = np.round(count_df[samples[::2]] * fold_changes).astype(int)
+    count_df.to_csv(tmp_path / 'counts.csv', index=False)
+    cds = CountDataSet(tmp_path / 'counts.csv', EXAMPLE_SAMPLE_DATA)
+    cds.normalize_counts()
+    full_df, full_var = cds.get_principal_components(3, None, 'variance')
+    cds.pca_randomized_min_features = 1
+    cds._pca_cache = {}
+    randomized_df, randomized_var = cds.get_principal_components(3, None, 'variance')
+    assert randomized_var['PC1'] == pytest.approx(full_var['PC1'], abs=0.05)
+    np.testing.assert_allclose(np.abs(randomized_df['PC1']), np.abs(full_df['PC1']), rtol=1e-2, atol=1e-2)
+
+
+@pytest.mark.parametrize('storage', ['sparse', 'dense'])
+def test_barcode_stats(count_file, storage):
+    cds = CountDataSet(count_file, EXAMPLE_SAMPLE_DATA, storage=storage)
+    cds.normalize_counts('clr')
+    cds.STATS_BLOCK_VALUES = 7 * len(cds.samples)
+    means, variances = cds.get_barcode_stats()
+    norm = cds.get_normalized_rows().astype(np.float64)
+    np.testing.assert_allclose(means, norm.mean(axis=1), rtol=1e-6, atol=1e-6)
+    np.testing.assert_allclose(variances, norm.var(axis=1, ddof=1), rtol=1e-6, atol=1e-6)
+    assert cds.get_barcode_stats()[1] is variances
+    top_rows = cds.get_top_variance_rows(50)
+    assert np.all(np.diff(top_rows) > 0)
+    assert set(top_rows) == set(np.argsort(-variances)[:50])
+    assert len(cds.get_top_variance_rows(10 ** 6)) == len(cds.barcodes)
+    cds.normalize_counts('cpm')
+    assert cds.get_barcode_stats()[1] is not variances
+
+
+def test_gene_index(count_file):
+    cds = CountDataSet(count_file, EXAMPLE_SAMPLE_DATA)
+    gene_names = np.asarray(cds.genes)
+    assert cds.get_gene_list() == sorted(set(gene_names))
+    assert cds.get_gene_list() is cds.get_gene_list()
+    rows = cds.get_gene_rows(['gene7', 'missing', 'gene3'])
+    assert list(rows) == list(np.flatnonzero(gene_names == 'gene7')) + list(np.flatnonzero(gene_names == 'gene3'))
+    assert cds.get_gene_rows(['missing']).size == 0
+
+
+def test_summarize_distribution():
+    rng = np.random.default_rng(5)
+    values = np.concatenate([rng.normal(0, 1, 5000), [12.0]])
+    stats = summarize_distribution(values, kde_points=200)
+    np.testing.assert_allclose([stats['q1'], stats['median'], stats['q3']], np.quantile(values, [0.25, 0.5, 0.75]))
+    assert stats['upperfence'] < 12 and stats['lowerfence'] >= stats['q1'] - 1.5 * (stats['q3'] - stats['q1'])
+    bandwidth = 1.059 * min(values.std(ddof=1), (stats['q3'] - stats['q1']) / 1.349) * values.size ** -0.2
+    expected = gaussian_kde(values, bw_method=bandwidth / values.std(ddof=1))(stats['kde_y'])
+    np.testing.assert_allclose(stats['kde_density'], expected, atol=5e-3)
+
+
+@pytest.mark.parametrize('box', [True, False])
+def test_barcode_abundance_summary_plot(count_file, box):
+    cds = CountDataSet(count_file, EXAMPLE_SAMPLE_DATA)
+    cds.normalize_counts()
+    cds.abundance_max_points = 30
+    gene_df = cds.get_gene_abundance(['gene3', 'gene7']).merge(cds.sample_data, on=cds.sample_id_col)
+    fig = cds.barcode_abundance_plot(gene_df, cds.gene_name_col, cds.sample_id_col, ['red', 'blue'], box=box,
+                                     summarize=True)
+    points = [t for t in fig.data if t.type == 'scatter' and t.mode == 'markers']
+    assert sum(len(t.y) for t in points) == 30
+    shapes = [t for t in fig.data if t not in points]
+    if box:
+        assert len(shapes) == len(cds.norm_samples) and all(len(t.q1) == 2 for t in shapes)
+    else:
+        assert len(shapes) == 2 * len(cds.norm_samples)
+    assert list(fig.layout.xaxis.ticktext) == ['gene3', 'gene7']
+    empty_df = cds.get_gene_abundance([]).merge(cds.sample_data, on=cds.sample_id_col)
+    fig = cds.barcode_abundance_plot(empty_df, cds.gene_name_col, cds.sample_id_col, ['red', 'blue'], box=box,
+                                     summarize=True)
+    assert not fig.data
+
+
+@pytest.fixture
+def store_config(tmp_path):
+    with open('scripts/config.yaml') as cf:
+        config = yaml.safe_load(cf)
+    config['eda']['merge']['store_dir'] = str(tmp_path / 'stores')
+    config_path = tmp_path / 'config.yaml'
+    config_path.write_text(yaml.safe_dump(config))
+    return str(config_path)
+
+
+@pytest.mark.parametrize('storage', ['sparse', 'dense'])
+def test_merge_sample_count_files(tmp_path, store_config, storage):
+    count_df = write_count_table(tmp_path / 'counts.csv')
+    sample_files = []
+    for sample in count_df.columns[2:]:
+        sample_df = count_df[['barcode', sample, 'Name']].drop_duplicates('barcode')
+        sample_df = sample_df.rename({sample: 'barcode_count'}, axis=1).sample(frac=1, random_state=0)
+        sample_df.to_csv(tmp_path / f'{sample}_mbarq_counts.csv', index=False)
+        sample_files.append(tmp_path / f'{sample}_mbarq_counts.csv')
+    merged = CountDataSet(tmp_path / 'counts.csv', EXAMPLE_SAMPLE_DATA, config_file=store_config, storage=storage)
+    cds = CountDataSet(None, EXAMPLE_SAMPLE_DATA, config_file=store_config, storage=storage,
+                       sample_count_files=sample_files[::-1])
+    assert cds.valid
+    assert cds.samples == [s for s in count_df.columns[2:][::-1] if s in merged.samples]
+    count_data = cds.count_data.set_index(cds.barcode_col)
+    expected = merged.count_data.set_index(cds.barcode_col)
+    expected = expected[(expected[cds.samples] > 0).any(axis=1)]
+    pd.testing.assert_frame_equal(count_data.loc[expected.index, cds.samples], expected[cds.samples])
+    assert set(count_data.index) == set(expected.index)
+    assert (count_data.loc[expected.index, cds.gene_name_col].astype(str)
+            == expected[cds.gene_name_col].astype(str)).all()
+    # The second load reads the existing store
+    assert len(list((tmp_path / 'stores').iterdir())) == 1
+    reloaded = CountDataSet(None, EXAMPLE_SAMPLE_DATA, config_file=store_config, storage=storage,
+                            sample_count_files=sample_files[::-1])
+    assert reloaded.count_hash == cds.count_hash
+    assert len(list((tmp_path / 'stores').iterdir())) == 1
+
+
+def test_merge_duplicated_barcodes(tmp_path, store_config):
+    samples = pd.read_csv(EXAMPLE_SAMPLE_DATA).iloc[:2, 0].tolist()
+    first = pd.DataFrame({'barcode': ['A', 'B', 'A', 'C'], 'barcode_count': [1, 2, 3, 4],
+                          'Name': ['g1', 'g2', 'g1', 'g3']})
+    second = pd.DataFrame({'barcode': ['D', 'C', 'D', 'B'], 'barcode_count': [5, 6, 7, 8],
+                           'Name': ['g4', 'g3', 'g4', 'g2']})
+    sample_files = []
+    for sample, sample_df in zip(samples, (first, second)):
+        sample_df.to_csv(tmp_path / f'{sample}_mbarq_counts.csv', index=False)
+        sample_files.append(tmp_path / f'{sample}_mbarq_counts.csv')
+    cds = CountDataSet(None, EXAMPLE_SAMPLE_DATA, config_file=store_config, sample_count_files=sample_files)
+    count_data = cds.count_data.set_index(cds.barcode_col)
+    # Rows follow first appearance across files; duplicated barcodes within a file are summed
+    assert list(count_data.index) == ['A', 'B', 'C', 'D']
+    assert count_data[samples].to_numpy().tolist() == [[4, 0], [2, 8], [4, 6], [0, 12]]
+    assert count_data[cds.gene_name_col].astype(str).tolist() == ['g1', 'g2', 'g3', 'g4']
+
+
+def test_merge_missing_gene_attribute(tmp_path, store_config):
+    count_df = write_count_table(tmp_path / 'counts.csv')
+    sample = count_df.columns[2]
+    count_df[['barcode', sample]].to_csv(tmp_path / f'{sample}_mbarq_counts.csv', index=False)
+    cds = CountDataSet(None, EXAMPLE_SAMPLE_DATA, config_file=store_config,
+                       sample_count_files=[tmp_path / f'{sample}_mbarq_counts.csv'])
+    assert not cds.valid
+
+
+@pytest.mark.parametrize('storage', ['sparse', 'dense'])
+@pytest.mark.parametrize('norm_method', ['cpm', 'clr'])
+def test_sample_correlation(count_file, storage, norm_method):
+    cds = CountDataSet(count_file, EXAMPLE_SAMPLE_DATA, storage=storage)
+    cds.normalize_counts(norm_method)
+    norm_df = pd.DataFrame(cds.get_normalized_rows().astype(np.float64), columns=cds.norm_samples)
+    for method in CORRELATION_METHODS:
+        corr_df, linkage = cds.get_sample_correlation(method)
+        expected = norm_df.corr(method=method).loc[corr_df.index, corr_df.columns]
+        np.testing.assert_allclose(corr_df.to_numpy(), expected.to_numpy(), atol=1e-5)
+        assert linkage.shape == (len(cds.norm_samples) - 1, 4)
+    rows = cds.get_top_variance_rows(100)
+    corr_df, _ = cds.get_sample_correlation('pearson', 100)
+    expected = norm_df.iloc[rows].corr().loc[corr_df.index, corr_df.columns]
+    np.testing.assert_allclose(corr_df.to_numpy(), expected.to_numpy(), atol=1e-5)
+    assert cds.get_sample_correlation('pearson', 100)[1] is cds.get_sample_correlation('pearson', 100)[1]
+    fig = cds.sample_correlation_figure(corr_df, cds.get_sample_correlation('pearson', 100)[1])
+    heatmap, = [t for t in fig.data if t.type == 'heatmap']
+    assert list(heatmap.x) == list(heatmap.y) == list(corr_df.columns)
+    assert heatmap.customdata is None and '%{x}' in heatmap.hovertemplate
+    # The whole dendrogram is one trace: 4 points and a gap per merge
+    dendrogram, = [t for t in fig.data if t.type == 'scatter']
+    assert len(dendrogram.x) == 5 * (len(corr_df) - 1)
+
+
+@pytest.mark.parametrize('storage', ['sparse', 'dense'])
+def test_gene_level(count_file, storage):
+    cds = CountDataSet(count_file, EXAMPLE_SAMPLE_DATA, storage=storage)
+    grouped = cds.count_data.drop(cds.barcode_col, axis=1).groupby(cds.gene_name_col, observed=True)[cds.samples]
+    expected = {'sum': grouped.sum(), 'median': grouped.median(), 'barcode_count': grouped.agg(lambda c: (c > 0).sum())}
+    for aggregation, expected_df in expected.items():
+        gene_level = cds.get_gene_level(aggregation)
+        assert gene_level is cds.get_gene_level(aggregation)
+        assert list(gene_level.barcodes) == list(expected_df.index)
+        count_data = gene_level.count_data.set_index(cds.barcode_col)[cds.samples]
+        np.testing.assert_allclose(count_data.to_numpy(dtype=float), expected_df.to_numpy(dtype=float))
+        gene_level.normalize_counts()
+        gene_level.get_principal_components(3, 10, 'variance')
+        corr_df, _ = gene_level.get_sample_correlation('spearman')
+        assert corr_df.shape == (len(gene_level.norm_samples),) * 2
+        assert len(gene_level.get_gene_abundance(['gene3'])) == len(gene_level.norm_samples)
+    assert cds.norm_counts is None and cds.level == 'barcode'
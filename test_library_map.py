@@ -1,5 +1,10 @@
+import io
+import numpy as np
+from pathlib import Path
+import pandas as pd
 import pandera as pa
 import yaml
+from scripts.datasets import LibraryMap
 
 with open('scripts/config.yaml', 'r') as cf:
     config = yaml.load(cf, Loader=yaml.SafeLoader)['library_map']
@@ -12,6 +17,24 @@ INSERTION_SITE_COL = col_name_config['insertion_site_col']
 ABUNDANCE_COL = col_name_config['abundance_col']
 BARCODE_COL = col_name_config['barcode_col']
 DISTANCE_COL = col_name_config['distance_col']
+EXAMPLE_MAP = Path('examples/example_library_map.annotated.csv')
+
+
+class UploadedMap(io.BytesIO):
+    """
+    Minimal stand-in for streamlit's UploadedFile
+    """
+    def __init__(self, path):
+        super().__init__(Path(path).read_bytes())
+        self.name = Path(path).name
+
+
+def load_example_map(cache_dir):
+    lm = LibraryMap(map_files=[UploadedMap(EXAMPLE_MAP)])
+    lm.cache_dir = cache_dir
+    lm.load_map()
+    lm.validate_lib_map()
+    return lm
 
 
 def test_get_stats():
@@ -35,3 +58,229 @@ def test_get_stats():
     pass
     # todo add other checks
 
+
+def test_load_map_cache(tmp_path):
+    lm = load_example_map(tmp_path)
+    assert (tmp_path / f"{lm.map_hash}.parquet").exists()
+    cached_lm = load_example_map(tmp_path)
+    assert cached_lm.map_hash == lm.map_hash
+    assert cached_lm.validated
+    assert cached_lm.attributes == lm.attributes
+    pd.testing.assert_frame_equal(cached_lm.lib_map, lm.lib_map.reset_index(drop=True))
+
+
+def test_load_map_cache_key(tmp_path):
+    lm = load_example_map(tmp_path)
+    for attribute, value in (('validation_mode', 'fast'), ('column_dtypes', {**lm.column_dtypes, DISTANCE_COL: 'int64'})):
+        other_lm = LibraryMap(map_files=[UploadedMap(EXAMPLE_MAP)])
+        other_lm.cache_dir = tmp_path
+        setattr(other_lm, attribute, value)
+        other_lm.load_map()
+        # A map cached under other validation settings or dtypes is not reused
+        assert other_lm.map_hash != lm.map_hash
+        assert (tmp_path / f"{other_lm.map_hash}.parquet").exists()
+
+
+
+def test_partial_map_not_cached(tmp_path):
+    map_df = pd.read_csv(EXAMPLE_MAP)
+    map_df.iloc[:500].to_csv(tmp_path / 'good.csv', index=False)
+    bad = map_df.iloc[500:1000].copy()
+    bad.loc[bad.index[5], ABUNDANCE_COL] = -1
+    bad.to_csv(tmp_path / 'bad.csv', index=False)
+    lm = LibraryMap(map_files=[UploadedMap(tmp_path / 'good.csv'), UploadedMap(tmp_path / 'bad.csv')])
+    lm.cache_dir = tmp_path
+    lm.load_map()
+    # The valid map is loaded, but not cached under the key of both files
+    assert len(lm.lib_map) == 500
+    assert not (tmp_path / f"{lm.map_hash}.parquet").exists()
+
+def test_chunked_ingest_dtypes(tmp_path):
+    lm = LibraryMap(map_files=[UploadedMap(EXAMPLE_MAP)])
+    lm.cache_dir = tmp_path
+    lm.chunksize = 100
+    lm.load_map()
+    full_map = pd.read_csv(EXAMPLE_MAP)
+    assert len(lm.lib_map) == len(full_map)
+    assert lm.lib_map[INSERTION_SITE_COL].dtype == 'int32'
+    assert lm.lib_map[ABUNDANCE_COL].dtype == 'uint32'
+    assert isinstance(lm.lib_map[CHR_COL].dtype, pd.CategoricalDtype)
+    assert isinstance(lm.lib_map['Name'].dtype, pd.CategoricalDtype)
+    assert set(lm.lib_map[CHR_COL].cat.categories) == set(full_map[CHR_COL])
+
+
+def test_coverage_bins(tmp_path):
+    lm = load_example_map(tmp_path)
+    chr_name = lm.lib_map[CHR_COL].iloc[0]
+    bins_df = lm.get_coverage_bins(chr_name, 50)
+    positions = lm.lib_map.loc[lm.lib_map[CHR_COL] == chr_name, INSERTION_SITE_COL]
+    expected_counts, _ = np.histogram(positions, bins=50)
+    assert len(bins_df) == 50
+    assert (bins_df['count'].to_numpy() == expected_counts).all()
+
+
+
+def test_graph_coverage_hist(tmp_path):
+    lm = load_example_map(tmp_path)
+    chr_name = lm.lib_map[CHR_COL].iloc[0]
+    fig = lm.graph_coverage_hist(chr_name, 50, '#366092')
+    bins_df = lm.get_coverage_bins(chr_name, 50)
+    assert sum(len(trace.y) for trace in fig.data) == len(bins_df)
+    assert sum(sum(trace.y) for trace in fig.data) == bins_df['count'].sum()
+    assert not fig.layout.shapes
+
+
+def test_graph_insertions(tmp_path):
+    lm = load_example_map(tmp_path)
+    chr_name = lm.lib_map[CHR_COL].iloc[0]
+    fig = lm.graph_insertions(chr_name, 'in CDS', ['#F79646', '#366092'])
+    assert sum(len(trace.x) for trace in fig.data) == (lm.lib_map[CHR_COL] == chr_name).sum()
+
+
+def test_graph_coverage_hist_gaps(tmp_path):
+    lm = load_example_map(tmp_path)
+    chrom = 'FQ312003.1'
+    gaps = lm.get_insertion_gaps(chrom, min_length=1000, max_gaps=10)
+    fig = lm.graph_coverage_hist(chrom, 50, '#366092', gaps)
+    shapes = fig.layout.shapes
+    assert len(shapes) == len(gaps) == 10
+    assert [(shape.x0, shape.x1) for shape in shapes] == list(zip(gaps['gap_start'], gaps['gap_end']))
+    # Gaps shade the full plot height behind the bars
+    assert all(shape.type == 'rect' and shape.yref == 'paper' and shape.layer == 'below' for shape in shapes)
+
+def test_track_tiles(tmp_path):
+    lm = load_example_map(tmp_path)
+    chr_name = lm.lib_map[CHR_COL].iloc[0]
+    n_insertions = (lm.lib_map[CHR_COL] == chr_name).sum()
+    start, end = lm.get_position_range(chr_name)
+    lm.track_config['max_tiles'] = 100
+    tiles = lm.get_track_tiles(chr_name, start, end)
+    assert 0 < len(tiles) <= 100
+    assert tiles['insertions'].sum() == n_insertions
+    assert (tiles['max_abundance'] >= tiles['mean_abundance']).all()
+    lm.track_config['max_raw_points'] = 10
+    fig = lm.graph_insertion_track(chr_name, start, end, 'library', ['red', 'blue'])
+    assert all(trace.type == 'scattergl' for trace in fig.data)
+    assert sum(len(trace.x) for trace in fig.data) == 2 * len(tiles)
+
+
+def test_position_index_range_query(tmp_path):
+    lm = load_example_map(tmp_path)
+    for chr_name in lm.lib_map[CHR_COL].unique():
+        start, end = 1_000_000, 2_000_000
+        expected = lm.lib_map[(lm.lib_map[CHR_COL] == chr_name)
+                              & lm.lib_map[INSERTION_SITE_COL].between(start, end)]
+        insertions = lm.get_insertions(chr_name, start, end)
+        assert insertions[INSERTION_SITE_COL].is_monotonic_increasing
+        assert sorted(insertions[BARCODE_COL]) == sorted(expected[BARCODE_COL])
+        assert len(lm.get_insertions(chr_name)) == (lm.lib_map[CHR_COL] == chr_name).sum()
+
+
+def test_get_stats_cached(tmp_path):
+    lm = load_example_map(tmp_path)
+    lm.get_stats()
+    stats = lm.stats
+    gene_col = lm.attributes[0]
+    assert list(stats.index) == sorted(lm.lib_map['library'].unique())
+    assert (stats['# of insertions'] == lm.lib_map[BARCODE_COL].nunique()).all()
+    assert (stats[f'Median insertions per {gene_col}'] <= stats[f'Max insertions per {gene_col}']).all()
+    lm.get_stats()
+    assert lm.stats is stats
+    lm.build_position_index()
+    lm.get_stats()
+    assert lm.stats is not stats
+
+
+def test_validation_modes_agree():
+    map_df = pd.read_csv(EXAMPLE_MAP)
+    map_df['library'] = 'example_library'
+    validated = {}
+    for mode in ['full', 'fast', 'sampled']:
+        lm = LibraryMap(map_df=map_df.copy())
+        lm.validation_mode = mode
+        lm.validation_sample_size = 100
+        lm.load_map()
+        lm.validate_lib_map()
+        validated[mode] = lm.lib_map
+    pd.testing.assert_frame_equal(validated['full'], validated['fast'])
+    pd.testing.assert_frame_equal(validated['full'], validated['sampled'])
+    map_df.loc[5, ABUNDANCE_COL] = -1
+    lm = LibraryMap(map_df=map_df)
+    lm.validation_mode = 'fast'
+    lm.load_map()
+    lm.validate_lib_map()
+    assert lm.lib_map.empty
+
+
+def test_shared_barcode_dictionary(tmp_path):
+    map_df = pd.read_csv(EXAMPLE_MAP)
+    first, second = map_df.iloc[:1000], map_df.iloc[500:]
+    first.to_csv(tmp_path / 'first.csv', index=False)
+    second.to_csv(tmp_path / 'second.csv', index=False)
+    lm = LibraryMap(map_files=[UploadedMap(tmp_path / 'first.csv'), UploadedMap(tmp_path / 'second.csv')])
+    lm.cache_dir = tmp_path
+    lm.load_map()
+    lm.validate_lib_map()
+    assert isinstance(lm.lib_map[BARCODE_COL].dtype, pd.CategoricalDtype)
+    assert lm.lib_map[BARCODE_COL].cat.categories.size == map_df[BARCODE_COL].nunique()
+    shared = set(first[BARCODE_COL]) & set(second[BARCODE_COL])
+    assert lm.get_barcode_overlap().loc['first.csv', 'second.csv'] == len(shared)
+    assert set(lm.get_shared_barcodes()[BARCODE_COL]) == shared
+    specific = lm.get_library_specific_barcodes()
+    assert set(specific.loc[specific['library'] == 'first.csv', BARCODE_COL]) == set(first[BARCODE_COL]) - shared
+
+
+
+def test_barcode_collisions_cached(tmp_path):
+    map_df = pd.read_csv(EXAMPLE_MAP)
+    first, second = map_df.iloc[:1000], map_df.iloc[500:].copy()
+    # The first 10 barcodes shared with the first library were inserted at other sites in the second one
+    moved = second.index[:10]
+    second.loc[moved, INSERTION_SITE_COL] += 1
+    first.to_csv(tmp_path / 'first.csv', index=False)
+    second.to_csv(tmp_path / 'second.csv', index=False)
+    lm = LibraryMap(map_files=[UploadedMap(tmp_path / 'first.csv'), UploadedMap(tmp_path / 'second.csv')])
+    lm.cache_dir = tmp_path
+    lm.load_map()
+    lm.validate_lib_map()
+    collisions = lm.get_barcode_collisions()
+    assert set(second.loc[moved, BARCODE_COL]) <= set(collisions[BARCODE_COL])
+    assert lm._barcode_collisions[0] == lm.map_version
+    cached = lm._barcode_collisions[1]
+    pd.testing.assert_frame_equal(lm.get_barcode_collisions(), collisions)
+    assert lm._barcode_collisions[1] is cached
+
+def test_gene_index(tmp_path):
+    lm = load_example_map(tmp_path)
+    genes = lm.get_genes_with_insertions('Name')
+    assert set(genes) == set(lm.lib_map['Name'].dropna())
+    for gene in genes[:20]:
+        expected = lm.lib_map[lm.lib_map['Name'] == gene]
+        pd.testing.assert_frame_equal(lm.get_gene_insertions(gene, 'Name'), expected)
+    assert lm.get_gene_insertions('not a gene', 'Name').empty
+
+
+
+def test_graph_needle(tmp_path):
+    lm = load_example_map(tmp_path)
+    gene = lm.get_genes_with_insertions('Name')[0]
+    fig = lm.graph_needle(gene, 'Name', 'library', ['#F79646', '#366092'])
+    n_insertions = len(lm.get_gene_insertions(gene, 'Name'))
+    assert sum(len(trace.x) for trace in fig.data) == n_insertions
+    assert fig.layout.annotations[0].text.strip('←→ ') == gene
+    # Needles run from zero up to each insertion's abundance
+    assert all((trace.error_y.arrayminus == trace.y).all() for trace in fig.data)
+
+def test_insertion_gaps(tmp_path):
+    lm = load_example_map(tmp_path)
+    chrom = 'FQ312003.1'
+    sites = np.unique(lm.lib_map.loc[lm.lib_map.chr == chrom, 'insertion_site'])
+    lengths = np.diff(sites) - 1
+    gaps = lm.get_insertion_gaps(chrom, min_length=1000, max_gaps=25)
+    assert len(gaps) == 25
+    assert gaps['length'].tolist() == sorted(lengths[lengths >= 1000], reverse=True)[:25]
+    assert (gaps['gap_end'] - gaps['gap_start'] + 1 == gaps['length']).all()
+    genes = lm.lib_map[['Name', 'gene_start', 'gene_end']].loc[lm.lib_map.chr == chrom].dropna().drop_duplicates()
+    for gap in gaps.itertuples():
+        overlapping = genes[(genes.gene_start <= gap.gap_end) & (genes.gene_end >= gap.gap_start)]
+        assert set(gap.genes.split(', ')) - {''} == set(overlapping.Name)
@@ -0,0 +1,238 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scripts.datasets import ResultDataSet, decimate_ranks
+
+EXAMPLE_RESULTS = 'examples/example_rra_results_annotated.csv'
+
+
+def write_result_files(tmp_path, n_libraries=2, seed=0):
+    """
+    Copies of the example results as separate libraries, with perturbed LFCs and a few missing values
+    """
+    rng = np.random.default_rng(seed)
+    result_files = []
+    for i in range(n_libraries):
+        df = pd.read_csv(EXAMPLE_RESULTS)
+        df['library'] = f'lib{i}'
+        df['LFC'] = df['LFC'] + rng.normal(0, 0.5, len(df))
+        df.loc[rng.random(len(df)) < 0.01, 'LFC'] = np.nan
+        path = tmp_path / f'lib{i}_rra_results.csv'
+        df.to_csv(path, index=False)
+        result_files.append(path)
+    return result_files
+
+
+@pytest.fixture
+def rds(tmp_path):
+    rds = ResultDataSet(result_files=write_result_files(tmp_path), gene_id='Name')
+    rds.load_results()
+    return rds
+
+
+def naive_hits(df, lfc_low, lfc_hi, fdr_th):
+    if not lfc_hi:
+        return ((abs(df['LFC']) > lfc_low) & (df['fdr'] < fdr_th)).to_numpy()
+    return ((df['LFC'] > lfc_low) & (df['LFC'] < lfc_hi) & (df['fdr'] < fdr_th)).to_numpy()
+
+
+@pytest.mark.parametrize('thresholds', [(1, None, 0.05), (0, None, 1), (0.5, None, 0.01),
+                                        (-2, -0.5, 0.05), (0.5, 3, 0.1), (1, None, 0),
+                                        (-1, None, 0.05), (-5, 0.0, 0.05)])
+def test_hit_mask_matches_naive(rds, thresholds):
+    mask = rds.get_hit_mask(*thresholds)
+    np.testing.assert_array_equal(mask, naive_hits(rds.results_df, *thresholds))
+    counts = rds.get_hit_counts(*thresholds).set_index(['library', 'contrast'])['hits']
+    expected = (rds.results_df.assign(hit=mask).groupby(['library', 'contrast'])['hit'].sum())
+    pd.testing.assert_series_equal(counts.sort_index(), expected.sort_index(), check_names=False,
+                                   check_dtype=False)
+
+
+def test_hit_index_cached(rds):
+    rds.get_hit_mask(1, None, 0.05)
+    hit_index = rds._hit_index[1]
+    assert rds.get_hit_mask(1, None, 0.05) is rds.get_hit_mask(1, None, 0.05)
+    assert rds._get_hit_index() is hit_index
+    # Replacing the results table rebuilds the index
+    rds.results_df = rds.results_df.iloc[::-1]
+    np.testing.assert_array_equal(rds.get_hit_mask(1, None, 0.05), naive_hits(rds.results_df, 1, None, 0.05))
+    assert rds._get_hit_index() is not hit_index
+
+
+def test_hit_index_built_at_validation(rds):
+    assert rds._hit_index[0] is None and rds._gene_aggregates[0] is None
+    rds.validate_results_df()
+    assert rds._hit_index[0] is rds.results_df
+    assert rds._gene_aggregates[0] is rds.results_df
+
+
+def test_identify_hits_rerun(rds):
+    rds.identify_hits('All', 1, None, 0.05)
+    hit_df = rds.hit_df
+    # A rerun with the same settings keeps the materialized hit table
+    rds.identify_hits('All', 1, None, 0.05)
+    assert rds.hit_df is hit_df
+    # New thresholds only rewrite the hit columns of the same table
+    lfc_median = hit_df['LFC_median'].to_numpy()
+    rds.identify_hits('All', 2, None, 0.05)
+    assert rds.hit_df is hit_df and np.shares_memory(hit_df['LFC_median'].to_numpy(), lfc_median)
+    np.testing.assert_array_equal(rds.hit_df['hit'], naive_hits(rds.results_df, 2, None, 0.05))
+    expected_sum = rds.hit_df.groupby(['Name', 'contrast'])['hit'].transform('sum')
+    np.testing.assert_array_equal(rds.hit_df['hit_sum'], expected_sum)
+    rds.results_df = rds.results_df.assign(annotation='x')
+    rds.identify_hits('All', 2, None, 0.05)
+    assert rds.hit_df is not hit_df and 'annotation' in rds.hit_df.columns
+
+
+@pytest.mark.parametrize('library_to_show', ['All', 'lib1'])
+def test_hit_df(rds, library_to_show):
+    assert rds.hit_df.empty
+    rds.identify_hits(library_to_show, 1, None, 0.05)
+    hit_df = rds.results_df.copy()
+    hit_df['hit'] = naive_hits(hit_df, 1, None, 0.05)
+    if library_to_show == 'All':
+        grouped = (hit_df.groupby(['Name', 'contrast'])
+                   .agg(LFC_median=('LFC', 'median'), library_nunique=('library', 'nunique'),
+                        hit_sum=('hit', 'sum')).reset_index())
+        hit_df = hit_df.merge(grouped, on=['Name', 'contrast'], how='left')
+    else:
+        hit_df = hit_df[hit_df['library'] == library_to_show].copy()
+        hit_df['LFC_median'] = hit_df['LFC']
+        hit_df['library_nunique'] = 1
+        hit_df['hit_sum'] = hit_df['hit']
+    pd.testing.assert_frame_equal(rds.hit_df, hit_df, check_dtype=False)
+
+
+def test_gene_aggregates(rds):
+    gene_aggregates = rds._get_gene_aggregates()
+    expected = (rds.results_df.groupby(['Name', 'contrast'])
+                .agg(LFC_median=('LFC', 'median'), library_nunique=('library', 'nunique')))
+    table = gene_aggregates['table']
+    pd.testing.assert_frame_equal(table.sort_index(), expected, check_dtype=False, check_names=False)
+    # Every row maps to the aggregate of its own (gene, contrast)
+    keys = table.index[gene_aggregates['key_codes']]
+    assert list(keys) == list(zip(rds.results_df['Name'], rds.results_df['contrast']))
+    assert rds._get_gene_aggregates() is gene_aggregates
+
+
+def test_decimate_ranks():
+    keep = np.zeros(10000, dtype=bool)
+    keep[[10, 5000, 9000]] = True
+    shown = decimate_ranks(keep, n_extremes=100, max_middle=500)
+    assert np.all(np.diff(shown) > 0)
+    assert set(np.flatnonzero(keep)) <= set(shown)
+    assert set(range(100)) | set(range(9900, 10000)) <= set(shown)
+    assert len(shown) <= 200 + 3 + 500
+    np.testing.assert_array_equal(decimate_ranks(keep[:150], 100, 500), np.arange(150))
+
+
+def test_rank_plot_gl(rds):
+    rds.rank_extreme_points, rds.rank_max_points = 20, 100
+    rds.identify_hits('All', 1, None, 0.05)
+    contrasts = sorted(rds.results_df['contrast'].unique())[:2]
+    fig = rds.graph_by_rank(contrast=contrasts, webgl=True)
+    assert all(trace.type == 'scattergl' for trace in fig.data)
+    rank_df = (rds.hit_df[rds.hit_df['contrast'].isin(contrasts)]
+               [['Name', 'contrast', 'LFC_median', 'hit', 'fdr']].drop_duplicates()
+               .sort_values('LFC_median', kind='stable').reset_index(drop=True))
+    drawn = pd.concat([pd.DataFrame({'rank': trace.x, 'LFC_median': trace.y,
+                                     'Name': trace.customdata[:, 0], 'hit': trace.name.startswith('True')})
+                       for trace in fig.data]).sort_values('rank')
+    assert drawn['hit'].sum() == rank_df['hit'].sum()
+    assert len(drawn) <= rank_df['hit'].sum() + 2 * 20 + 100
+    # Drawn ranks are the ranks among all genes of the selected contrasts
+    expected = rank_df.loc[drawn['rank']]
+    np.testing.assert_array_equal(drawn['LFC_median'], expected['LFC_median'])
+    np.testing.assert_array_equal(drawn['Name'], expected['Name'])
+    rank_table = rds._rank_table[2]
+    rds.graph_by_rank(contrast=contrasts[:1], webgl=True)
+    assert rds._rank_table[2] is rank_table
+
+
+def test_rank_table_page_reruns(rds):
+    contrasts = sorted(rds.results_df['contrast'].unique())[:2]
+    # Each page rerun calls identify_hits before drawing
+    rds.identify_hits('All', 1, None, 0.05)
+    rds.graph_by_rank(contrast=contrasts, webgl=True)
+    rank_table = rds._rank_table[2]
+    rds.identify_hits('All', 1, None, 0.05)
+    rds.graph_by_rank(contrast=contrasts[:1], webgl=True)
+    assert rds._rank_table[2] is rank_table
+    # New thresholds keep the rank order and only gather the new hit calls
+    rds.identify_hits('All', 2, None, 0.05)
+    fig = rds.graph_by_rank(contrast=contrasts, webgl=True)
+    assert rds._rank_table[2] is rank_table
+    n_hits = (rds.hit_df[rds.hit_df['contrast'].isin(contrasts)][['Name', 'contrast', 'LFC_median', 'hit', 'fdr']]
+              .drop_duplicates()['hit'].sum())
+    assert sum(len(trace.x) for trace in fig.data if trace.name.startswith('True')) == n_hits
+    # Another library selection has its own order
+    rds.identify_hits('lib0', 2, None, 0.05)
+    fig = rds.graph_by_rank(contrast=contrasts, webgl=True)
+    assert rds._rank_table[2] is not rank_table
+    lib_df = rds.hit_df[rds.hit_df['contrast'].isin(contrasts)]
+    assert sum(len(trace.x) for trace in fig.data if trace.name.startswith('True')) == lib_df['hit'].sum()
+
+
+@pytest.mark.parametrize('library_to_show', ['All', 'lib0'])
+def test_lfc_matrix(rds, library_to_show):
+    rds.identify_hits(library_to_show, 1, None, 0.05)
+    lfc_matrix = rds._lfc_matrices[1][library_to_show]
+    assert rds.get_lfc_matrix(library_to_show) is lfc_matrix
+    df = rds.results_df if library_to_show == 'All' else rds.results_df[rds.results_df['library'] == library_to_show]
+    expected = df.groupby(['Name', 'contrast'])['LFC'].median().unstack()
+    pd.testing.assert_frame_equal(pd.DataFrame(lfc_matrix['matrix'], index=lfc_matrix['genes'],
+                                               columns=lfc_matrix['contrasts']),
+                                  expected, check_names=False)
+    # Heatmaps gather the same values the pivot of the hit table gives
+    name_counts = df.groupby(['Name', 'contrast']).size().groupby('Name').max()
+    genes = list(name_counts[name_counts == 1].index[:40])
+    heat_df = rds._lfc_heat_df(genes[::-1] + ['not_a_gene'])
+    pivot = (rds.hit_df[rds.hit_df['Name'].isin(genes)][['Name', 'contrast', 'LFC_median']]
+             .drop_duplicates().pivot(index='Name', columns='contrast', values='LFC_median'))
+    pd.testing.assert_frame_equal(heat_df, pivot, check_names=False)
+
+
+def test_pathway_heatmap(rds):
+    rds.identify_hits('All', 1, None, 0.05)
+    tags = list(rds.results_df['locus_tag'].unique()[:30]) + ['absent_tag']
+    fig = rds.display_pathway_heatmap(tags, 'locus_tag')
+    labels = list(fig.data[0].y)
+    assert 'absent_tag' in labels and len(labels) == len(set(labels))
+    z = pd.DataFrame(fig.data[0].z, index=labels, columns=fig.data[0].x)
+    assert z.loc['absent_tag'].isna().all()
+    first = rds.results_df.iloc[0]
+    label = f"{first['locus_tag']}: {first['Name']}" if first['Name'] != first['locus_tag'] else first['locus_tag']
+    expected = rds.results_df[(rds.results_df['Name'] == first['Name'])
+                              & (rds.results_df['contrast'] == first['contrast'])]['LFC'].median()
+    assert z.loc[label, first['contrast']] == pytest.approx(expected)
+
+
+@pytest.mark.parametrize('metric', ['euclidean', 'correlation'])
+def test_clustered_heatmap(rds, metric):
+    from scipy.cluster import hierarchy
+    rds.identify_hits('All', 1, None, 0.05)
+    genes = list(rds.results_df['Name'].unique()[:60])
+    heat_df = rds._lfc_heat_df(genes)
+    fig = rds.graph_heatmap(genes, cluster=True, metric=metric)
+    row_linkage, col_linkage = rds.get_heatmap_linkage(heat_df, metric)
+    assert rds.get_heatmap_linkage(heat_df, metric)[0] is row_linkage
+    heatmap = [trace for trace in fig.data if trace.type == 'heatmap'][0]
+    row_order, col_order = hierarchy.leaves_list(row_linkage), hierarchy.leaves_list(col_linkage)
+    np.testing.assert_array_equal(heatmap.z, heat_df.to_numpy()[row_order][:, col_order])
+    assert list(heatmap.y) == list(heat_df.index[row_order])
+    assert list(heatmap.x) == list(heat_df.columns[col_order])
+    # One trace per dendrogram, with 4 points and a gap per merge
+    gene_dendrogram, contrast_dendrogram = [trace for trace in fig.data if trace.type == 'scatter']
+    assert len(gene_dendrogram.y) == 5 * (len(heat_df) - 1)
+    assert len(contrast_dendrogram.x) == 5 * (heat_df.shape[1] - 1)
+    with pytest.raises(ValueError):
+        rds.get_heatmap_linkage(heat_df, 'cosine')
+
+
+def test_heatmap(rds):
+    rds.identify_hits('All', 1, None, 0.05)
+    genes = list(rds.results_df['Name'].unique()[:60])
+    fig = rds.graph_heatmap(genes)
+    heat_df = rds._lfc_heat_df(genes)
+    assert list(fig.data[0].y) == list(heat_df.index)
+    np.testing.assert_array_equal(fig.data[0].z, heat_df.to_numpy())